@@ -1,36 +1,1356 @@
+import argparse
 import asyncio
+import base64
+import collections
+import copy
+import hashlib
+import itertools
 import json
+import logging
+import math
+import mimetypes
+import multiprocessing
+import os
+import random
+import re
+import signal
+import sqlite3
+import struct
+import tempfile
 import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import quote
+import aiohttp
 from aiohttp import web
 import aiohttp_cors
 
-# Global state
-class MusicState:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger('musync')
+
+SONG_STORE_DIR = os.environ.get('MUSYNC_STORE_DIR', os.path.join('musync_data', 'songs'))
+SONG_READ_CHUNK = 256 * 1024
+# Songs sent with a room snapshot and per get_playlist page; relays always get the whole playlist
+PLAYLIST_PAGE_SIZE = int(os.environ.get('MUSYNC_PLAYLIST_PAGE_SIZE', 200))
+# Chat messages kept in memory per room and sent with the room snapshot; older ones live in
+# an append-only JSON-lines archive per room that clients page through with get_chat_history
+CHAT_HISTORY_SIZE = int(os.environ.get('MUSYNC_CHAT_HISTORY_SIZE', 50))
+CHAT_LOG_DIR = os.environ.get('MUSYNC_CHAT_DIR', os.path.join('musync_data', 'chat'))
+CHAT_PAGE_LIMIT = 100
+CHAT_ARCHIVE_BLOCK = 64 * 1024  # Bytes read per step when paging back through an archive
+# Room metadata (playlist, playback, chat, requests) is saved to this SQLite database every
+# SNAPSHOT_INTERVAL seconds and on shutdown, and loaded when a room is first joined. Empty disables it
+SNAPSHOT_DB = os.environ.get('MUSYNC_SNAPSHOT_DB', os.path.join('musync_data', 'rooms.db'))
+SNAPSHOT_INTERVAL = float(os.environ.get('MUSYNC_SNAPSHOT_INTERVAL', 10))
+# Chat is fanned out as one chat_batch frame per tick instead of a frame per message
+CHAT_BATCH_INTERVAL = float(os.environ.get('MUSYNC_CHAT_BATCH_MS', 75)) / 1000
+# Per-user token bucket: sustained messages per second and the burst allowed on top
+CHAT_RATE = float(os.environ.get('MUSYNC_CHAT_RATE', 2))
+CHAT_BURST = int(os.environ.get('MUSYNC_CHAT_BURST', 5))
+# Joins, leaves and count changes within this window go out as one presence patch
+PRESENCE_INTERVAL = float(os.environ.get('MUSYNC_PRESENCE_MS', 100)) / 1000
+# A client that drops without closing cleanly keeps its identity and role this many seconds, and
+# patches it missed are replayed from a per-room log instead of resending the whole state
+RESUME_GRACE = float(os.environ.get('MUSYNC_RESUME_GRACE', 30))
+PATCH_LOG_SIZE = 500
+CLEAN_CLOSE_CODES = (1000, 1001)  # Closed by the page (normal closure, navigating away)
+# Song requests: pending ones per user, seconds between a user's requests, and resolved ones kept per room
+REQUEST_MAX_PENDING = int(os.environ.get('MUSYNC_REQUEST_MAX_PENDING', 3))
+REQUEST_INTERVAL = float(os.environ.get('MUSYNC_REQUEST_INTERVAL', 10))
+REQUEST_ARCHIVE_SIZE = 50
+# Binary upload frame: [u8 upload id length][u64 byte offset][upload id][payload]
+UPLOAD_FRAME_HEADER = struct.Struct('!BQ')
+# Unfinished uploads idle for longer than this are discarded along with their temp files
+UPLOAD_TTL = float(os.environ.get('MUSYNC_UPLOAD_TTL', 600))
+# Base64 chunks of legacy uploads held in memory across all rooms; past this budget, or once a single
+# upload holds more than the spill threshold, further chunks are written to a temp file instead
+UPLOAD_MEMORY_BUDGET = int(os.environ.get('MUSYNC_UPLOAD_MEMORY_BUDGET', 256 * 1024 * 1024))
+UPLOAD_SPILL_THRESHOLD = int(os.environ.get('MUSYNC_UPLOAD_SPILL_THRESHOLD', 8 * 1024 * 1024))
+# Per-user limits on concurrent uploads and on the total size they declare
+UPLOAD_MAX_PER_USER = int(os.environ.get('MUSYNC_UPLOAD_MAX_PER_USER', 4))
+UPLOAD_USER_QUOTA = int(os.environ.get('MUSYNC_UPLOAD_USER_QUOTA', 2 * 1024 * 1024 * 1024))
+# Outbound frames buffered per client before the overflow policy kicks in
+SEND_QUEUE_SIZE = int(os.environ.get('MUSYNC_SEND_QUEUE_SIZE', 256))
+# drop_stale: drop the oldest droppable frame; coalesce: replace the whole backlog with one fresh snapshot;
+# disconnect: like drop_stale, but close the socket once SLOW_CONSUMER_LIMIT frames have been dropped
+SEND_QUEUE_POLICY = os.environ.get('MUSYNC_SEND_QUEUE_POLICY', 'drop_stale')
+SLOW_CONSUMER_LIMIT = int(os.environ.get('MUSYNC_SLOW_CONSUMER_LIMIT', 1024))
+# Playback is scheduled far enough ahead for the slowest 5% of listeners to get the command in time
+LEAD_MIN_MS = int(os.environ.get('MUSYNC_LEAD_MIN_MS', 50))
+LEAD_MAX_MS = int(os.environ.get('MUSYNC_LEAD_MAX_MS', 1500))
+LEAD_DECODE_MARGIN_MS = int(os.environ.get('MUSYNC_LEAD_DECODE_MARGIN_MS', 30))
+SCHEDULE_LOG_SIZE = 20
+# Processes that read duration, bitrate and tags out of uploaded files
+METADATA_WORKERS = int(os.environ.get('MUSYNC_METADATA_WORKERS', 1))
+METADATA_FIELDS = ('codec', 'duration', 'sample_rate', 'bitrate', 'title', 'artist')
+# How often the event loop is checked for stalls; /stats reports the worst delay over the last minute
+LOOP_LAG_INTERVAL = 0.1
+DEFAULT_ROOM = 'default'
+ROOM_NAME_PATTERN = re.compile(r'^[\w-]{1,64}$')
+# Rooms without listeners for this long are dropped from memory
+ROOM_IDLE_TIMEOUT = float(os.environ.get('MUSYNC_ROOM_IDLE_TIMEOUT', 3600))
+
+# Worker processes relay room events to each other through a broker on this Unix socket
+BROKER_PATH = os.environ.get('MUSYNC_BROKER_PATH')
+BROKER_FRAME_HEADER = struct.Struct('!I')
+WORKERS = int(os.environ.get('MUSYNC_WORKERS', 1))
+
+# Relay mode: mirror rooms from an upstream Musync server instead of hosting them
+RELAY_UPSTREAM = os.environ.get('MUSYNC_RELAY_UPSTREAM')
+# Shared secret relays present upstream; relay connections are refused while it is unset
+RELAY_TOKEN = os.environ.get('MUSYNC_RELAY_TOKEN')
+RELAY_LOCAL_MESSAGES = ('set_username', 'get_state', 'ping', 'sync_report', 'playback_report', 'playback_late',
+                        'get_chat_history', 'get_playlist')
+RELAY_FORWARDED_MESSAGES = ('chat', 'request_song')
+
+class SongStore:
+    """Content-addressed audio blobs on disk, keyed by SHA-256 and reference counted."""
+    
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.refs = {}  # sha256 -> number of playlist entries using the blob
+        self.saved = {}  # sha256 -> entries in saved rooms that are not loaded
+    
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+    
+    def open_temp(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.part')
+        return tmp_path, os.fdopen(fd, 'wb')
+    
+    def adopt(self, tmp_path, digest):
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    
+    def open_spill(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, spill_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.spill')
+        return spill_path, fd
+    
+    def acquire(self, digest):
+        self.refs[digest] = self.refs.get(digest, 0) + 1
+    
+    def restore(self, digest):
+        # A saved room's entry is back in memory
+        count = self.saved.get(digest, 0) - 1
+        if count > 0:
+            self.saved[digest] = count
+        else:
+            self.saved.pop(digest, None)
+        self.acquire(digest)
+    
+    def shelve(self, digest):
+        # A loaded room's entry is going back to the snapshot database only
+        count = self.refs.get(digest, 0) - 1
+        if count > 0:
+            self.refs[digest] = count
+        else:
+            self.refs.pop(digest, None)
+        self.saved[digest] = self.saved.get(digest, 0) + 1
+    
+    def release(self, digest):
+        count = self.refs.get(digest, 0) - 1
+        if count > 0:
+            self.refs[digest] = count
+            return
+        self.refs.pop(digest, None)
+        if self.saved.get(digest):
+            return
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+store = SongStore(SONG_STORE_DIR)
+
+class SnapshotStore:
+    """Saved room metadata in SQLite. Audio is referenced by hash, never copied in, and every
+    query runs on one background thread so the event loop never waits on the disk."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshots')
+        self.saved = {}  # room name -> fingerprint of the state last written
+    
+    def run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+    
+    def connect(self):
+        if self.db is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Workers of one server share the file
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS rooms (name TEXT PRIMARY KEY, saved_at REAL, data TEXT);
+                CREATE TABLE IF NOT EXISTS song_refs (room TEXT, digest TEXT, refs INTEGER, PRIMARY KEY (room, digest));
+            """)
+        return self.db
+    
+    def read_refs(self):
+        # Enough to start up: blobs used by saved rooms must survive until those rooms are loaded
+        return dict(self.connect().execute('SELECT digest, SUM(refs) FROM song_refs GROUP BY digest'))
+    
+    def read(self, name):
+        row = self.connect().execute('SELECT data FROM rooms WHERE name = ?', (name,)).fetchone()
+        return codec.loads(row[0]) if row else None
+    
+    def write(self, name, snapshot):
+        # Encoded here too: for a long playlist that alone would stall the event loop
+        data = codec.dumps(snapshot)
+        refs = collections.Counter(song['hash'] for song in snapshot['playlist'] if song['hash'])
+        db = self.connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO rooms VALUES (?, ?, ?)', (name, snapshot['saved_at'], data))
+            db.execute('DELETE FROM song_refs WHERE room = ?', (name,))
+            db.executemany('INSERT INTO song_refs VALUES (?, ?, ?)', [(name, digest, count) for digest, count in refs.items()])
+    
+    def save(self, state):
+        """Queues a write of the room if it changed since the last one; returns its future, or None."""
+        fingerprint = room_fingerprint(state)
+        if self.saved.get(state.name) == fingerprint:
+            return None
+        snapshot = room_snapshot(state)
+        self.saved[state.name] = fingerprint
+        future = self.run(self.write, state.name, snapshot)
+        future.add_done_callback(lambda future: self.written(state.name, fingerprint, future))
+        return future
+    
+    def written(self, name, fingerprint, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        logger.error('Saving room %s failed', name, exc_info=future.exception())
+        if self.saved.get(name) == fingerprint:
+            # Tried again on the next round
+            del self.saved[name]
+    
+    def shelve(self, state):
+        self.save(state)
+        del self.saved[state.name]
+        for song in state.playlist:
+            if song['hash']:
+                store.shelve(song['hash'])
+
+snapshots = SnapshotStore(SNAPSHOT_DB) if SNAPSHOT_DB else None
+
+class ChatArchive:
+    """Append-only JSON-lines chat log per room. Appends go through a file handle kept open per
+    room, and appends and reads run in order on one background thread, so chat never waits on the disk."""
+    
+    def __init__(self, root):
+        self.root = root
+        self.files = {}  # room name -> open log; only touched on the archive thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-archive')
+    
+    def path(self, name):
+        return os.path.join(self.root, name + '.jsonl')
+    
+    def append(self, name, message):
+        self.executor.submit(self.write, name, codec.dumps(message) + '\n')
+    
+    def close(self, name):
+        self.executor.submit(self.close_file, name)
+    
+    async def read(self, name, before, limit):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.read_file, name, before, limit)
+    
+    def write(self, name, line):
+        f = self.files.get(name)
+        if f is None:
+            os.makedirs(self.root, exist_ok=True)
+            f = self.files[name] = open(self.path(name), 'a', encoding='utf-8')
+        f.write(line)
+        f.flush()
+    
+    def close_file(self, name):
+        f = self.files.pop(name, None)
+        if f:
+            f.close()
+    
+    def read_file(self, name, before, limit):
+        """Up to `limit` archived messages older than `before`, oldest first; None if the room has no archive.
+        
+        Reads backwards a block at a time, so recent pages cost the same however long the room has been chatting.
+        """
+        messages = []
+        try:
+            f = open(self.path(name), 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            end = f.seek(0, os.SEEK_END)
+            tail = b''
+            while end > 0 and len(messages) < limit:
+                start = max(0, end - CHAT_ARCHIVE_BLOCK)
+                f.seek(start)
+                lines = (f.read(end - start) + tail).split(b'\n')
+                # The first line may be cut off by the block boundary; keep it for the next block
+                tail = lines.pop(0) if start else b''
+                for line in reversed(lines):
+                    if line:
+                        message = codec.loads(line)
+                        if before is None or message['timestamp'] < before:
+                            messages.append(message)
+                end = start
+        messages.reverse()
+        return messages[-limit:]
+
+chat_archive = ChatArchive(CHAT_LOG_DIR)
+
+# Playback timestamps come from the monotonic clock, anchored once to wall-clock time so
+# they stay comparable with clients' clocks but never jump when the system clock is adjusted
+CLOCK_ANCHOR_MS = time.time() * 1000 - time.monotonic() * 1000
+
+def server_now_ms():
+    return CLOCK_ANCHOR_MS + time.monotonic() * 1000
+
+class JsonCodec:
+    name = 'json'
+    
+    def dumps(self, message):
+        return json.dumps(message, ensure_ascii=False, separators=(',', ':'))
+    
+    def loads(self, data):
+        return json.loads(data)
+
+class OrjsonCodec:
+    name = 'orjson'
+    
+    def dumps(self, message):
+        return orjson.dumps(message).decode()
+    
+    def loads(self, data):
+        return orjson.loads(data)
+
+# Used for every frame in and out; orjson is picked up automatically when installed
+codec = OrjsonCodec() if orjson else JsonCodec()
+
+class UploadManager:
+    """Admission and byte accounting for in-flight uploads, so a burst of them cannot exhaust memory."""
+    
+    def __init__(self):
+        self.in_flight = 0
+        self.bytes_held = 0  # Received by unfinished uploads, in memory or on disk
+        self.memory_bytes = 0
+        self.users = {}  # user id -> {'uploads', 'reserved'}
+    
+    def admit(self, upload, user_id, size):
+        """Registers `upload` against its owner's limits; returns the reason it was refused, or None."""
+        user = self.users.get(user_id, {'uploads': 0, 'reserved': 0})
+        if user['uploads'] >= UPLOAD_MAX_PER_USER:
+            return 'too many uploads in progress'
+        if user['reserved'] + size > UPLOAD_USER_QUOTA:
+            return 'upload quota exceeded'
+        user['uploads'] += 1
+        user['reserved'] += size
+        self.users[user_id] = user
+        self.in_flight += 1
+        upload.update(owner=user_id, reserved=size, held=0, memory=0)
+        return None
+    
+    def grow(self, upload, size):
+        """Raises the upload's reservation to `size` bytes if its owner's quota allows."""
+        user = self.users[upload['owner']]
+        extra = size - upload['reserved']
+        if user['reserved'] + extra > UPLOAD_USER_QUOTA:
+            return 'upload quota exceeded'
+        user['reserved'] += extra
+        upload['reserved'] = size
+        return None
+    
+    def must_spill(self, upload, size):
+        return (upload['memory'] + size > UPLOAD_SPILL_THRESHOLD
+                or self.memory_bytes + size > UPLOAD_MEMORY_BUDGET)
+    
+    def hold(self, upload, size, in_memory=False):
+        upload['held'] += size
+        self.bytes_held += size
+        if in_memory:
+            upload['memory'] += size
+            self.memory_bytes += size
+    
+    def release(self, upload):
+        # Safe to call more than once: only the first call for an upload gives anything back
+        user_id = upload.pop('owner', None)
+        if user_id is None:
+            return
+        user = self.users[user_id]
+        user['uploads'] -= 1
+        user['reserved'] -= upload['reserved']
+        if not user['uploads']:
+            del self.users[user_id]
+        self.in_flight -= 1
+        self.bytes_held -= upload['held']
+        self.memory_bytes -= upload['memory']
+    
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'bytes_held': self.bytes_held,
+            'memory_bytes': self.memory_bytes,
+            'disk_bytes': self.bytes_held - self.memory_bytes,
+            'users': len(self.users)
+        }
+
+uploads = UploadManager()
+
+class Outbox:
+    """Bounded outbound queue for one socket, drained by its own writer task.
+    
+    Frames are (kind, payload) pairs in two lanes. 'playback' and 'control' frames go in the
+    control lane, which is always written first so timing-critical frames overtake bulk
+    traffic; a new playback frame replaces any pending one, since it carries the whole
+    playback state. Everything else goes in the bulk lane. 'patch', 'chat' and 'state'
+    frames may be dropped, after which a fresh snapshot is queued so the client catches up;
+    at most one is pending at a time. A 'state' frame with no payload is rendered when it is
+    written, so it is always current. 'reply' frames are never dropped: a client whose queue
+    is full with nothing left to drop has stopped reading and is disconnected.
+    """
+    
+    DROPPABLE = ('patch', 'chat', 'state')
+    CONTROL = ('playback', 'control')
+    RESYNC = ('state', None)
+    
+    def __init__(self, ws, state):
+        self.ws = ws
+        self.state = state
+        self.control = collections.deque()
+        self.queue = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.collapsed = 0
+        self.peak = 0
+        self.closing = False
+        self.resync = False  # A RESYNC frame is queued
+        self.task = asyncio.create_task(self.run())
+    
+    def put(self, kind, payload):
+        if self.closing:
+            return
+        if kind in self.CONTROL:
+            self.put_control(kind, payload)
+            return
+        if kind in self.DROPPABLE and self.resync:
+            # The queued snapshot is rendered at write time and already covers this frame
+            self.drop()
+            return
+        if len(self.queue) >= SEND_QUEUE_SIZE:
+            self.overflow()
+            if self.closing:
+                return
+            if kind in self.DROPPABLE:
+                self.drop()
+                return
+            if len(self.queue) >= SEND_QUEUE_SIZE and not self.shed():
+                self.disconnect()
+                return
+        self.queue.append((kind, payload))
+        self.peak = max(self.peak, len(self.queue))
+        self.wakeup.set()
+    
+    def put_control(self, kind, payload):
+        if kind == 'playback':
+            pending = len(self.control)
+            self.control = collections.deque(frame for frame in self.control if frame[0] != 'playback')
+            self.collapsed += pending - len(self.control)
+        if len(self.control) >= SEND_QUEUE_SIZE:
+            self.control.popleft()
+            self.drop()
+        self.control.append((kind, payload))
+        self.wakeup.set()
+    
+    def drop(self, count=1):
+        self.dropped += count
+        if SEND_QUEUE_POLICY == 'disconnect' and self.dropped >= SLOW_CONSUMER_LIMIT:
+            self.disconnect()
+    
+    def disconnect(self):
+        if not self.closing:
+            self.closing = True
+            self.control.clear()
+            self.queue.clear()
+            asyncio.create_task(self.ws.close())
+    
+    def shed(self):
+        """Drops the oldest droppable frame other than the pending resync; False if there is none."""
+        for i, frame in enumerate(self.queue):
+            if frame[0] in self.DROPPABLE and frame != self.RESYNC:
+                del self.queue[i]
+                self.drop()
+                return True
+        return False
+    
+    def overflow(self):
+        if SEND_QUEUE_POLICY == 'coalesce':
+            kept = [frame for frame in self.queue if frame[0] not in self.DROPPABLE]
+            dropped = len(self.queue) - len(kept)
+            self.queue = collections.deque(kept)
+            self.resync = False
+            self.drop(dropped)
+        else:
+            self.shed()
+        if self.closing or self.resync:
+            return
+        if len(self.queue) >= SEND_QUEUE_SIZE:
+            # Nothing could be dropped to make room for the snapshot
+            self.disconnect()
+            return
+        self.queue.append(self.RESYNC)
+        self.resync = True
+        self.peak = max(self.peak, len(self.queue))
+    
+    async def run(self):
+        try:
+            while True:
+                if self.control:
+                    kind, payload = self.control.popleft()
+                elif self.queue:
+                    kind, payload = self.queue.popleft()
+                    if payload is None:
+                        self.resync = False
+                else:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                if payload is None:
+                    client = self.state.clients.get(self.ws)
+                    if client is None:
+                        break
+                    payload = codec.dumps(state_snapshot(self.state, client))
+                await self.ws.send_str(payload)
+                self.sent += 1
+        except (ConnectionError, RuntimeError):
+            # The socket went away; the handler's finally block cleans up
+            pass
+    
+    def close(self):
+        self.task.cancel()
+    
+    def stats(self):
+        return {
+            'queue_depth': len(self.control) + len(self.queue),
+            'control_depth': len(self.control),
+            'peak_depth': self.peak,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'collapsed': self.collapsed
+        }
+
+class Client:
+    """One socket in a room."""
+    
+    __slots__ = ('ws', 'id', 'username', 'is_admin', 'can_upload', 'sync', 'playback', 'relay',
+                 'listeners', 'outbox', 'chat_allowance', 'chat_checked', 'last_request', 'token')
+    
+    def __init__(self, ws, user_id, is_admin, relay, outbox):
+        self.ws = ws
+        self.id = user_id
+        self.username = None
+        self.is_admin = is_admin
+        self.can_upload = is_admin  # Admins can always upload
+        self.sync = None  # Latest clock estimate reported by the client
+        self.playback = None  # Latest playback error report from the client
+        self.relay = relay
+        self.listeners = 0 if relay else 1  # Relays report how many listeners they serve
+        self.outbox = outbox
+        self.chat_allowance = CHAT_BURST
+        self.chat_checked = time.monotonic()
+        self.last_request = None
+        self.token = uuid.uuid4().hex  # Lets the client resume this identity after a dropped connection
+    
+    def speaking_for(self, username, user_id):
+        # Messages a relay forwards speak for one of its listeners
+        proxy = copy.copy(self)
+        proxy.username = username
+        proxy.id = f'{self.id}/{user_id}' if user_id else self.id
+        return proxy
+    
+    def allow_chat(self):
+        now = time.monotonic()
+        self.chat_allowance = min(CHAT_BURST, self.chat_allowance + (now - self.chat_checked) * CHAT_RATE)
+        self.chat_checked = now
+        if self.chat_allowance < 1:
+            return False
+        self.chat_allowance -= 1
+        return True
+    
+    def allow_request(self):
+        now = time.monotonic()
+        if self.last_request is not None and now - self.last_request < REQUEST_INTERVAL:
+            return False
+        self.last_request = now
+        return True
+
+class ClientRegistry:
+    """A room's clients by socket and by user id, plus join-ordered indexes per role.
+    
+    'listener' holds every client that is not a relay, oldest first, so the next admin
+    is always the first entry; 'admin' and 'relay' hold what their names say.
+    """
+    
+    ROLES = ('admin', 'listener', 'relay')
+    
     def __init__(self):
-        self.playlist = []  # List of {id, name, data}
-        self.current_song_index = -1
+        self.by_ws = {}
+        self.by_id = {}
+        self.roles = {role: collections.OrderedDict() for role in self.ROLES}
+    
+    def __len__(self):
+        return len(self.by_ws)
+    
+    def __iter__(self):
+        return iter(self.by_ws)
+    
+    def __getitem__(self, ws):
+        return self.by_ws[ws]
+    
+    def get(self, ws):
+        return self.by_ws.get(ws)
+    
+    def values(self):
+        return self.by_ws.values()
+    
+    def items(self):
+        return self.by_ws.items()
+    
+    def find(self, user_id):
+        return self.by_id.get(user_id)
+    
+    def first(self, role):
+        index = self.roles[role]
+        return index[next(iter(index))] if index else None
+    
+    def add(self, client):
+        self.by_ws[client.ws] = client
+        self.by_id[client.id] = client
+        self.roles['relay' if client.relay else 'listener'][client.ws] = client
+        if client.is_admin:
+            self.roles['admin'][client.ws] = client
+    
+    def remove(self, ws):
+        client = self.by_ws.pop(ws, None)
+        if client:
+            del self.by_id[client.id]
+            for index in self.roles.values():
+                index.pop(ws, None)
+        return client
+    
+    def set_admin(self, client, is_admin):
+        client.is_admin = client.can_upload = is_admin
+        if is_admin:
+            self.roles['admin'][client.ws] = client
+        else:
+            self.roles['admin'].pop(client.ws, None)
+
+class RequestStore:
+    """A room's song requests. Pending ones are indexed by id and by requester; resolved
+    ones move to a short archive."""
+    
+    def __init__(self):
+        self.pending = {}  # id -> {id, song_name, requested_by, user_id, status}, oldest first
+        self.by_user = {}  # user id -> {folded song name: request id}
+        self.resolved = collections.deque(maxlen=REQUEST_ARCHIVE_SIZE)
+    
+    @staticmethod
+    def key(song_name):
+        return ' '.join(song_name.split()).casefold()
+    
+    def check(self, user_id, song_name):
+        """Returns why the user may not request `song_name` now, or None."""
+        mine = self.by_user.get(user_id, {})
+        if self.key(song_name) in mine:
+            return 'You already requested that song'
+        if len(mine) >= REQUEST_MAX_PENDING:
+            return 'You have too many pending requests'
+        return None
+    
+    def add(self, request):
+        self.pending[request['id']] = request
+        self.by_user.setdefault(request['user_id'], {})[self.key(request['song_name'])] = request['id']
+    
+    def resolve(self, request_id, status):
+        request = self.pending.pop(request_id, None)
+        if request:
+            mine = self.by_user[request['user_id']]
+            mine.pop(self.key(request['song_name']), None)
+            if not mine:
+                del self.by_user[request['user_id']]
+            request['status'] = status
+            self.resolved.append(request)
+        return request
+    
+    def dump(self):
+        return list(self.pending.values())
+
+class Playlist:
+    """A room's songs in play order: an id -> song map threaded by a doubly linked list.
+    
+    Inserting, moving and removing a song and stepping to its neighbours are O(1).
+    Positional access walks the list, so clients fetch long playlists a page at a time.
+    """
+    
+    def __init__(self, songs=()):
+        self.songs = {}  # id -> {id, name, hash, size, mime} plus METADATA_FIELDS
+        self.links = {}  # id -> [previous id, next id]
+        self.head = None
+        self.tail = None
+        for song in songs:
+            self.append(song)
+    
+    def __len__(self):
+        return len(self.songs)
+    
+    def __iter__(self):
+        song_id = self.head
+        while song_id is not None:
+            yield self.songs[song_id]
+            song_id = self.links[song_id][1]
+    
+    def get(self, song_id):
+        return self.songs.get(song_id)
+    
+    def neighbour(self, song_id, step):
+        """Id of the song before (step -1) or after (step 1) `song_id`; stepping forward from nowhere starts at the top."""
+        if song_id not in self.links:
+            return self.head if step > 0 else None
+        return self.links[song_id][step > 0]
+    
+    def insert(self, song, after):
+        """Places `song` after the song with id `after`, or first when `after` is None."""
+        song_id = song['id']
+        following = self.links[after][1] if after is not None else self.head
+        self.songs[song_id] = song
+        self.links[song_id] = [after, following]
+        if after is None:
+            self.head = song_id
+        else:
+            self.links[after][1] = song_id
+        if following is None:
+            self.tail = song_id
+        else:
+            self.links[following][0] = song_id
+    
+    def append(self, song):
+        self.insert(song, self.tail)
+    
+    def remove(self, song_id):
+        song = self.songs.pop(song_id)
+        previous, following = self.links.pop(song_id)
+        if previous is None:
+            self.head = following
+        else:
+            self.links[previous][1] = following
+        if following is None:
+            self.tail = previous
+        else:
+            self.links[following][0] = previous
+        return song
+    
+    def move(self, song_id, after):
+        self.insert(self.remove(song_id), after)
+    
+    def page(self, offset, limit):
+        return list(itertools.islice(self, offset, offset + limit))
+
+class MusicState:
+    def __init__(self, name):
+        self.name = name
+        self.empty_since = time.time()
+        self.playlist = Playlist()
+        self.current_song_id = None
         self.is_playing = False
         self.start_time = None
         self.current_position = 0
-        self.clients = {}  # ws: {id, username, is_admin, can_upload}
+        self.clients = ClientRegistry()
+        self.listener_count = 0  # Listeners connected here, including those behind relays
+        self.presence_count = 0  # User count in the last presence patch
+        self.presence_published = 0  # Listener count last published to other workers
+        self.presence_joined = []  # Names for the next presence patch
+        self.presence_left = []
+        self.presence_flush = None
         self.admin_id = None
-        self.chat_messages = []
-        self.song_requests = []  # List of {id, song_name, requested_by, user_id, status}
+        self.admin_since = None  # When the admin took over; the earliest claim wins between workers
+        self.admin_worker = None
+        self.remote_counts = {}  # worker id -> listeners that worker has in this room
+        self.chat_messages = collections.deque(maxlen=CHAT_HISTORY_SIZE)
+        self.chat_pending = []  # Waiting for the next chat_batch
+        self.chat_flush = None
+        self.song_requests = RequestStore()
         self.upload_chunks = {}  # Temporary storage for chunked uploads
+        self.version = 0  # Bumped by every patch; clients request a snapshot when they see a gap
+        self.playback_seq = 0  # Bumped by every playback message; those carry the full playback state
+        self.upstream = None  # RelayLink when this room is mirrored from another server
+        self.lead_ms = None  # Lead time used for the latest scheduled start
+        self.advance_timer = None  # Fires when the current track ends
+        self.schedule_log = collections.deque(maxlen=SCHEDULE_LOG_SIZE)  # Recent scheduled starts and who got them late
+        self.epoch = uuid.uuid4().hex  # Versions only compare within one process's copy of the room
+        self.patch_log = collections.deque(maxlen=PATCH_LOG_SIZE)  # (version, encoded patch)
+        self.sessions = {}  # resume token -> {id, username, can_upload, expires}
+        self.session_timers = {}  # resume token -> expiry timer, for sessions dropped here
+        self.loaded = False  # Holds the whole room: restored, synced, or started here; only these are saved
+        self.restored = False  # Loaded from a snapshot; a live copy from another worker replaces it
         
+    def user_count(self):
+        count = self.listener_count + sum(self.remote_counts.values())
+        if self.upstream:
+            count += self.upstream.others
+        return count
+    
+    def is_empty(self):
+        # A relay stays attached while it has nobody listening and must keep the room alive
+        return not self.listener_count and not self.clients.roles['relay'] and not any(self.remote_counts.values())
+    
     def get_current_position(self):
         if self.is_playing and self.start_time:
-            elapsed = (time.time() * 1000 - self.start_time) / 1000
+            elapsed = (server_now_ms() - self.start_time) / 1000
             return self.current_position + elapsed
         return self.current_position
     
     def get_current_song(self):
-        if 0 <= self.current_song_index < len(self.playlist):
-            return self.playlist[self.current_song_index]
+        return self.playlist.get(self.current_song_id)
+    
+    def find_song(self, song_id):
+        return self.playlist.get(song_id)
+
+class RoomRegistry:
+    """All live rooms by name. Each room is a MusicState with its own clients, admin and chat."""
+    
+    def __init__(self):
+        self.rooms = {}
+    
+    def get(self, name):
+        state = self.rooms.get(name)
+        if state is None:
+            state = self.rooms[name] = MusicState(name)
+        return state
+    
+    def evict_idle(self):
+        expired = time.time() - ROOM_IDLE_TIMEOUT
+        for name, state in list(self.rooms.items()):
+            if state.is_empty() and state.empty_since < expired:
+                del self.rooms[name]
+                if state.upstream:
+                    state.upstream.close()
+                if state.advance_timer:
+                    state.advance_timer.cancel()
+                if state.chat_flush:
+                    state.chat_flush.cancel()
+                if state.presence_flush:
+                    state.presence_flush.cancel()
+                for timer in state.session_timers.values():
+                    timer.cancel()
+                chat_archive.close(name)
+                for upload in state.upload_chunks.values():
+                    discard_upload(upload)
+                if snapshots and not state.upstream and state.loaded:
+                    # Kept on disk, and its songs in the store, until someone joins again
+                    snapshots.shelve(state)
+                    continue
+                for song in state.playlist:
+                    if song['hash']:
+                        store.release(song['hash'])
+
+rooms = RoomRegistry()
+
+# This worker's connection to the broker, or None when running as a single process
+broker = None
+
+def song_payload(state, song):
+    return {'id': song['id'], 'name': song['name'], 'url': f"/songs/{song['id']}?room={quote(state.name)}"}
+
+def spill_legacy_chunk(upload, offset, data):
+    os.pwrite(upload['spill'], data, offset)
+
+def legacy_chunks(upload):
+    # Chunks are either base64 text held in memory or (offset, length) ranges of the spill file
+    for i in range(upload['total_chunks']):
+        chunk = upload['chunks'][i]
+        if isinstance(chunk, tuple):
+            chunk = os.pread(upload['spill'], chunk[1], chunk[0]).decode('ascii')
+        yield chunk
+
+def assemble_legacy_upload(upload):
+    # Runs in a worker thread. The data URL is decoded a chunk at a time straight into the store,
+    # so memory stays flat however large the upload is
+    tmp_path, f = store.open_temp()
+    hasher = hashlib.sha256()
+    size = 0
+    mime = None
+    pending = ''
+    try:
+        with f:
+            for chunk in legacy_chunks(upload):
+                pending += chunk
+                if mime is None:
+                    if ',' not in pending:
+                        continue
+                    header, _, pending = pending.partition(',')
+                    mime = header[5:].split(';')[0] if header.startswith('data:') else ''
+                # Decode whole 4-character groups and carry the rest into the next chunk
+                cut = len(pending) - len(pending) % 4
+                audio_bytes = base64.b64decode(pending[:cut], validate=True)
+                pending = pending[cut:]
+                f.write(audio_bytes)
+                hasher.update(audio_bytes)
+                size += len(audio_bytes)
+            if pending:
+                raise ValueError('truncated upload')
+            if not size:
+                raise ValueError('empty upload')
+    except ValueError:
+        os.remove(tmp_path)
+        raise
+    digest = hasher.hexdigest()
+    store.adopt(tmp_path, digest)
+    return digest, size, mime
+
+def write_upload_frame(upload, payload):
+    upload['file'].write(payload)
+    upload['hasher'].update(payload)
+
+def finish_upload_file(upload):
+    upload['file'].close()
+    digest = upload['hasher'].hexdigest()
+    store.adopt(upload['path'], digest)
+    return digest
+
+def parse_upload_frame(frame):
+    """Splits a binary upload frame into (upload id, offset, payload), or returns None if it is malformed."""
+    start = UPLOAD_FRAME_HEADER.size
+    if len(frame) < start:
+        return None
+    id_length, offset = UPLOAD_FRAME_HEADER.unpack_from(frame)
+    if len(frame) < start + id_length:
+        return None
+    try:
+        upload_id = frame[start:start + id_length].decode()
+    except UnicodeDecodeError:
+        return None
+    return upload_id, offset, memoryview(frame)[start + id_length:]
+
+def guess_mime(song_name, mime=''):
+    return mime or mimetypes.guess_type(song_name)[0] or 'application/octet-stream'
+
+# Pure-Python header parsers; they run in the metadata process pool, never on the event loop
+
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+MPEG_SAMPLE_RATES = [44100, 48000, 32000]
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+# Sync words turn up by chance in any binary data; a stream only counts once this many frames run back to back
+MPEG_SYNC_FRAMES = 3
+
+def decode_text(data, encoding=3):
+    if encoding == 1:
+        text = data.decode('utf-16', 'replace')
+    elif encoding == 2:
+        text = data.decode('utf-16-be', 'replace')
+    else:
+        text = data.decode('latin-1' if encoding == 0 else 'utf-8', 'replace')
+    return text.strip('\x00 ').split('\x00')[0] or None
+
+def read_id3v2(f, info):
+    """Reads title/artist from a leading ID3v2 tag and returns the offset just past it."""
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    version = header[3]
+    size = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | header[9] & 0x7f
+    tag = f.read(size)
+    names = {b'TIT2': 'title', b'TPE1': 'artist', b'TT2': 'title', b'TP1': 'artist'}
+    pos = 0
+    id_length, header_length = (3, 6) if version == 2 else (4, 10)
+    while pos + header_length <= len(tag) and tag[pos] != 0:
+        frame_id = tag[pos:pos + id_length]
+        raw_size = tag[pos + id_length:pos + header_length - (0 if version == 2 else 2)]
+        if version == 4:
+            frame_size = raw_size[0] << 21 | raw_size[1] << 14 | raw_size[2] << 7 | raw_size[3]
+        else:
+            frame_size = int.from_bytes(raw_size, 'big')
+        body = tag[pos + header_length:pos + header_length + frame_size]
+        if frame_id in names and body and not info.get(names[frame_id]):
+            info[names[frame_id]] = decode_text(body[1:], body[0])
+        pos += header_length + frame_size
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+def mpeg_header(data, i):
+    """((version bits, layer, sample rate), bitrate, frame length) for an MPEG audio frame header at data[i], or None."""
+    if i + 4 > len(data) or data[i] != 0xff or data[i + 1] & 0xe0 != 0xe0:
+        return None
+    b1, b2 = data[i + 1], data[i + 2]
+    version_bits, layer_bits = (b1 >> 3) & 3, (b1 >> 1) & 3
+    if version_bits == 1 or layer_bits == 0 or b2 >> 4 in (0, 15) or (b2 >> 2) & 3 == 3:
+        return None
+    version = 1 if version_bits == 3 else 2
+    layer = 4 - layer_bits
+    sample_rate = MPEG_SAMPLE_RATES[(b2 >> 2) & 3] >> {3: 0, 2: 1, 0: 2}[version_bits]
+    bitrate = MPEG_BITRATES[(version, layer)][b2 >> 4] * 1000
+    padding = (b2 >> 1) & 1
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        length = (72 if layer == 3 and version == 2 else 144) * bitrate // sample_rate + padding
+    return (version_bits, layer, sample_rate), bitrate, length
+
+def adts_header(data, i):
+    """(sample rate, frame length) for an ADTS frame header at data[i], or None."""
+    if i + 7 > len(data) or data[i] != 0xff or data[i + 1] & 0xf6 != 0xf0:
         return None
+    rate_index = (data[i + 2] >> 2) & 0xf
+    length = (data[i + 3] & 3) << 11 | data[i + 4] << 3 | data[i + 5] >> 5
+    if rate_index >= len(ADTS_SAMPLE_RATES) or length < 7:
+        return None
+    return ADTS_SAMPLE_RATES[rate_index], length
+
+def frames_follow(data, i, read_header):
+    """True if MPEG_SYNC_FRAMES frames of the same stream run back to back from data[i]."""
+    stream = None
+    for _ in range(MPEG_SYNC_FRAMES):
+        header = read_header(data, i)
+        if header is None or stream not in (None, header[0]):
+            return False
+        stream = header[0]
+        i += header[-1]
+    return True
+
+def parse_mpeg(f, info, start, file_size):
+    f.seek(start)
+    data = f.read(65536)
+    for i in range(len(data) - 4):
+        if data[i] != 0xff or data[i + 1] & 0xe0 != 0xe0:
+            continue
+        if (data[i + 1] >> 1) & 3 == 0:
+            if frames_follow(data, i, adts_header):
+                return parse_adts(f, info, start + i, file_size)
+            continue
+        if not frames_follow(data, i, mpeg_header):
+            continue
+        (version_bits, layer, sample_rate), bitrate, _ = mpeg_header(data, i)
+        version = 1 if version_bits == 3 else 2
+        samples_per_frame = 384 if layer == 1 else 576 if layer == 3 and version == 2 else 1152
+        mono = data[i + 3] >> 6 == 3
+        info.update(codec=f'mp{layer}', sample_rate=sample_rate)
         
-state = MusicState()
+        audio_bytes = file_size - start - i
+        f.seek(max(0, file_size - 128))
+        if f.read(3) == b'TAG':
+            audio_bytes -= 128
+        # A Xing/Info or VBRI header in the first frame gives the frame count of VBR files
+        side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+        xing = data[i + 4 + side_info:i + 4 + side_info + 12]
+        frames = None
+        if xing[:4] in (b'Xing', b'Info') and int.from_bytes(xing[4:8], 'big') & 1:
+            frames = int.from_bytes(xing[8:12], 'big')
+        elif data[i + 36:i + 40] == b'VBRI':
+            frames = int.from_bytes(data[i + 50:i + 54], 'big')
+        if frames:
+            info['duration'] = frames * samples_per_frame / sample_rate
+            info['bitrate'] = int(audio_bytes * 8 / info['duration']) if info['duration'] else None
+        elif bitrate:
+            # Assumes every frame has the first one's bitrate, which only holds for CBR files
+            info['duration'] = audio_bytes * 8 / bitrate
+            info['bitrate'] = bitrate
+            info['estimated'] = True
+        return info
+    return info
+
+def parse_adts(f, info, start, file_size):
+    f.seek(start)
+    header = f.read(7)
+    sample_rate = ADTS_SAMPLE_RATES[(header[2] >> 2) & 0xf]
+    frames = 0
+    pos = start
+    # ADTS has no index; every frame header has to be visited to count the 1024-sample frames
+    while pos + 7 <= file_size:
+        f.seek(pos)
+        header = f.read(7)
+        if len(header) < 7 or header[0] != 0xff or header[1] & 0xf6 != 0xf0:
+            break
+        length = (header[3] & 3) << 11 | header[4] << 3 | header[5] >> 5
+        if length < 7:
+            break
+        frames += 1
+        pos += length
+    info.update(codec='aac', sample_rate=sample_rate)
+    if frames:
+        info['duration'] = frames * 1024 / sample_rate
+        info['bitrate'] = int((pos - start) * 8 / info['duration'])
+    return info
+
+def parse_vorbis_comment(data, info):
+    pos = 4 + int.from_bytes(data[:4], 'little')
+    count = int.from_bytes(data[pos:pos + 4], 'little')
+    pos += 4
+    for _ in range(count):
+        length = int.from_bytes(data[pos:pos + 4], 'little')
+        key, _, value = data[pos + 4:pos + 4 + length].decode('utf-8', 'replace').partition('=')
+        pos += 4 + length
+        if key.upper() in ('TITLE', 'ARTIST') and value and not info.get(key.lower()):
+            info[key.lower()] = value
+
+def parse_flac(f, info, start, file_size):
+    f.seek(start + 4)
+    info['codec'] = 'flac'
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        block_type, length = header[0] & 0x7f, int.from_bytes(header[1:], 'big')
+        block = f.read(length)
+        if block_type == 0:
+            streaminfo = int.from_bytes(block[10:18], 'big')
+            info['sample_rate'] = streaminfo >> 44
+            total_samples = streaminfo & (1 << 36) - 1
+            if info['sample_rate'] and total_samples:
+                info['duration'] = total_samples / info['sample_rate']
+                info['bitrate'] = int((file_size - start) * 8 / info['duration'])
+        elif block_type == 4:
+            parse_vorbis_comment(block, info)
+        if header[0] & 0x80:
+            break
+    return info
+
+def parse_ogg(f, info, file_size):
+    f.seek(0)
+    head = f.read(65536)
+    pre_skip = 0
+    if b'OpusHead' in head:
+        i = head.index(b'OpusHead')
+        pre_skip = int.from_bytes(head[i + 10:i + 12], 'little')
+        info.update(codec='opus', sample_rate=int.from_bytes(head[i + 12:i + 16], 'little'))
+        granule_rate = 48000
+        comments = head.find(b'OpusTags')
+        comments = comments + 8 if comments >= 0 else -1
+    elif b'\x01vorbis' in head:
+        i = head.index(b'\x01vorbis')
+        info.update(codec='vorbis', sample_rate=int.from_bytes(head[i + 12:i + 16], 'little'))
+        info['bitrate'] = int.from_bytes(head[i + 20:i + 24], 'little', signed=True) or None
+        granule_rate = info['sample_rate']
+        comments = head.find(b'\x03vorbis')
+        comments = comments + 7 if comments >= 0 else -1
+    else:
+        return info
+    if comments >= 0:
+        try:
+            parse_vorbis_comment(head[comments:], info)
+        except (ValueError, IndexError):
+            pass
+    # The granule position of the last page is the total sample count
+    f.seek(max(0, file_size - 65536))
+    tail = f.read()
+    last_page = tail.rfind(b'OggS')
+    if last_page >= 0 and granule_rate:
+        granule = int.from_bytes(tail[last_page + 6:last_page + 14], 'little')
+        info['duration'] = max(0, granule - pre_skip) / granule_rate
+        if info['duration'] and not info.get('bitrate'):
+            info['bitrate'] = int(file_size * 8 / info['duration'])
+    return info
+
+def parse_wav(f, info, file_size):
+    f.seek(12)
+    byte_rate = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk_id, length = header[:4], int.from_bytes(header[4:], 'little')
+        if chunk_id == b'data':
+            if byte_rate:
+                # Streams written on the fly often leave the data size at 0 or 0xffffffff
+                if length in (0, 0xffffffff):
+                    length = file_size - f.tell()
+                info['duration'] = length / byte_rate
+            f.seek(length + (length & 1), 1)
+            continue
+        body = f.read(length + (length & 1))
+        if chunk_id == b'fmt ':
+            info['codec'] = 'pcm' if int.from_bytes(body[:2], 'little') == 1 else 'wav'
+            info['sample_rate'] = int.from_bytes(body[4:8], 'little')
+            byte_rate = int.from_bytes(body[8:12], 'little')
+            info['bitrate'] = byte_rate * 8
+        elif chunk_id == b'LIST' and body[:4] == b'INFO':
+            pos = 4
+            while pos + 8 <= len(body):
+                sub_id, sub_length = body[pos:pos + 4], int.from_bytes(body[pos + 4:pos + 8], 'little')
+                key = {b'INAM': 'title', b'IART': 'artist'}.get(sub_id)
+                if key:
+                    info[key] = decode_text(body[pos + 8:pos + 8 + sub_length])
+                pos += 8 + sub_length + (sub_length & 1)
+    return info
+
+def mp4_boxes(f, start, end):
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        size, box_type = int.from_bytes(header[:4], 'big'), header[4:]
+        offset = 8
+        if size == 1:
+            size, offset = int.from_bytes(f.read(8), 'big'), 16
+        elif size == 0:
+            size = end - pos
+        if size < offset:
+            return
+        yield box_type, pos + offset, pos + size
+        pos += size
+
+def parse_mp4(f, info, file_size):
+    # Containers are walked by seeking, so a moov box at the end of a large file costs nothing extra
+    containers = (b'moov', b'trak', b'mdia', b'minf', b'stbl', b'udta', b'ilst')
+    tags = {b'\xa9nam': 'title', b'\xa9ART': 'artist'}
+    def walk(start, end):
+        for box_type, body, box_end in mp4_boxes(f, start, end):
+            if box_type in containers:
+                walk(body, box_end)
+            elif box_type == b'meta':
+                walk(body + 4, box_end)
+            elif box_type == b'mvhd':
+                f.seek(body)
+                data = f.read(32)
+                if data[0] == 1:
+                    timescale, duration = int.from_bytes(data[20:24], 'big'), int.from_bytes(data[24:32], 'big')
+                else:
+                    timescale, duration = int.from_bytes(data[12:16], 'big'), int.from_bytes(data[16:20], 'big')
+                if timescale:
+                    info['duration'] = duration / timescale
+            elif box_type == b'stsd' and not info.get('codec'):
+                f.seek(body + 8)
+                entry = f.read(36)
+                info['codec'] = {b'mp4a': 'aac', b'alac': 'alac', b'Opus': 'opus', b'fLaC': 'flac'}.get(entry[4:8], entry[4:8].decode('latin-1'))
+                info['sample_rate'] = int.from_bytes(entry[32:36], 'big') >> 16
+            elif box_type in tags:
+                for data_type, data_body, data_end in mp4_boxes(f, body, box_end):
+                    if data_type == b'data':
+                        f.seek(data_body + 8)
+                        info[tags[box_type]] = decode_text(f.read(data_end - data_body - 8))
+    walk(0, file_size)
+    if info.get('duration'):
+        info['bitrate'] = int(file_size * 8 / info['duration'])
+    return info
+
+def probe_audio(path):
+    """Returns {codec, duration, sample_rate, bitrate, title, artist} for an audio file; unknown fields are None.
+    'estimated' is also set when the duration is only a guess from the bitrate."""
+    info = dict.fromkeys(('codec', 'duration', 'sample_rate', 'bitrate', 'title', 'artist'))
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            return parse_wav(f, info, file_size)
+        if head[:4] == b'OggS':
+            return parse_ogg(f, info, file_size)
+        if head[4:8] == b'ftyp':
+            return parse_mp4(f, info, file_size)
+        f.seek(0)
+        start = read_id3v2(f, info)
+        f.seek(start)
+        if f.read(4) == b'fLaC':
+            return parse_flac(f, info, start, file_size)
+        f.seek(max(0, file_size - 128))
+        if f.read(3) == b'TAG' and not (info['title'] and info['artist']):
+            # ID3v1 as a last resort for tags
+            tag = f.read(60)
+            info['title'] = info['title'] or decode_text(tag[:30], 0)
+            info['artist'] = info['artist'] or decode_text(tag[30:], 0)
+        return parse_mpeg(f, info, start, file_size)
+
+# Started with the app; None until then, e.g. when handlers are driven directly
+metadata_pool = None
+
+async def extract_metadata(state, song):
+    try:
+        info = await asyncio.get_running_loop().run_in_executor(metadata_pool, probe_audio, store.path(song['hash']))
+    except Exception:
+        # Unreadable or unsupported files keep whatever the browser told us
+        return
+    if state.find_song(song['id']) is not song:
+        return
+    apply_metadata(state, song, info)
+    publish(state, 'metadata', id=song['id'], info=info)
+
+def apply_metadata(state, song, info):
+    if not any(info.values()):
+        return
+    duration = info.get('duration')
+    # A guess from the bitrate only fills in for a missing browser measurement
+    if not duration or (info.get('estimated') and song['duration']):
+        duration = song['duration']
+    song.update({field: info.get(field) for field in METADATA_FIELDS if field != 'duration'})
+    broadcast_patch(state, 'playlist_update', song=playlist_entry({**song, 'duration': duration}))
+    if duration != song['duration']:
+        set_duration(state, song, duration)
+
+def playlist_entry(song):
+    return {'id': song['id'], 'name': song['name'], **{field: song.get(field) for field in METADATA_FIELDS}}
+
+def add_song(state, song_name, digest, size, mime, duration=None, uploader=None):
+    store.acquire(digest)
+    song = {
+        'id': str(uuid.uuid4()),
+        'name': song_name,
+        'hash': digest,
+        'size': size,
+        'mime': guess_mime(song_name, mime),
+        **dict.fromkeys(METADATA_FIELDS),
+        'duration': duration,  # Seconds, as measured by the uploader's browser until the file has been parsed
+        'uploader': uploader  # User id of whoever uploaded it
+    }
+    after = state.playlist.tail
+    state.playlist.append(song)
+    broadcast_patch(state, 'playlist_insert', after=after, song=playlist_entry(song))
+    publish(state, 'playlist_insert', song=song)
+    if metadata_pool:
+        asyncio.create_task(extract_metadata(state, song))
+    return song
+
+def remove_song(state, song_id):
+    song = state.find_song(song_id)
+    if song:
+        was_playing = song_id == state.current_song_id
+        if was_playing:
+            state.current_song_id = unlink_current(state)
+        state.playlist.remove(song_id)
+        store.release(song['hash'])
+        if was_playing:
+            # The next track starts from its beginning, as when stepping to it; peers get the
+            # playback event ahead of the removal, so they never step on their own
+            state.current_position = 0
+            state.is_playing = state.is_playing and state.current_song_id is not None
+            state.start_time = schedule_start(state) if state.is_playing else None
+            broadcast_playback(state, 'now_playing')
+        broadcast_patch(state, 'playlist_remove', id=song_id)
+    return song
+
+def unlink_current(state):
+    # The track after the current one takes its place, or the one before when it was last
+    previous, following = state.playlist.links[state.current_song_id]
+    return following or previous
+
+def move_song(state, song_id, after):
+    if song_id == after or song_id not in state.playlist.songs or (after is not None and after not in state.playlist.songs):
+        return False
+    state.playlist.move(song_id, after)
+    broadcast_patch(state, 'playlist_move', id=song_id, after=after)
+    return True
 
 HTML_CONTENT = """
 <!DOCTYPE html>
@@ -610,7 +1930,8 @@ HTML_CONTENT = """
     <script>
         const vinyl = document.getElementById('visualizerParams');
         const audio = document.getElementById('audio');
-        const CHUNK_SIZE = 64 * 1024; 
+        const CHUNK_SIZE = 256 * 1024;
+        const UPLOAD_WINDOW = 16;  // chunks allowed in flight before waiting for acks
         
         const elements = {
             playBtn: document.getElementById('playBtn'),
@@ -648,12 +1969,45 @@ HTML_CONTENT = """
         };
         
         let ws;
-        let serverTimeOffset = 0;
+        // Clock sync: pong samples in a sliding window; the offset comes from the lowest-RTT ones
+        const CLOCK_WINDOW = 32;
+        const CLOCK_BURST = 8;
+        let clockSamples = [];
+        let clock = { offset: 0, drift: 0, ref: 0, rtt: null, jitter: null };
+        let pingsSent = 0;
+        // Drift correction: small errors are absorbed by nudging playbackRate, large ones by seeking
+        const DRIFT_DEADBAND = 0.015;
+        const DRIFT_HARD_SEEK = 0.25;
+        const DRIFT_MAX_NUDGE = 0.05;
+        let driftErrors = [];
+        let hardSeeks = 0;
         let isAdmin = false;
         let canUpload = false;
         let userId = null;
         let username = localStorage.getItem('sync_username') || 'Guest-' + Math.floor(Math.random() * 1000);
         let isSeeking = false;
+        // Rooms are addressed as /rooms/<name> or ?room=<name>
+        const roomMatch = window.location.pathname.match(/^\\/rooms\\/([\\w-]+)/);
+        const room = roomMatch ? roomMatch[1] : (new URLSearchParams(window.location.search).get('room') || 'default');
+        let currentSongId = null;
+        let currentPlayback = null;
+        let alignTimer = null;
+        // The first playlist.length of playlistSize songs; more are fetched as the list is scrolled
+        let playlist = [];
+        let playlistSize = 0;
+        let playlistLoading = false;
+        let songRequests = [];  // Pending requests; only the admin receives them
+        let stateVersion = null;
+        let stateEpoch = null;
+        let playbackSeq = -1;
+        // A dropped connection resumes this session and catches up from the versions last seen
+        let resumeToken = null;
+        let lastChatTimestamp = 0;
+        let reconnectAttempts = 0;
+        // Timestamp of the oldest chat message shown; scrolling to the top pages back from it
+        let chatOldest = null;
+        let chatLoading = false;
+        const activeUploads = new Map();
         
         // --- Helper: Generate consistent color from string ---
         function stringToColor(str) {
@@ -720,8 +2074,71 @@ HTML_CONTENT = """
             }
         }
 
+        // performance.now() is monotonic; anchoring it to timeOrigin keeps it on the wall-clock scale the server uses
+        function clientNow() {
+            return performance.timeOrigin + performance.now();
+        }
+        
         function getServerTime() {
-            return Date.now() + serverTimeOffset;
+            const now = clientNow();
+            return now + clock.offset + clock.drift * (now - clock.ref);
+        }
+        
+        function sendPing() {
+            if (ws && ws.readyState === WebSocket.OPEN) {
+                pingsSent++;
+                ws.send(JSON.stringify({ type: 'ping', client_time: clientNow() }));
+            }
+        }
+        
+        function startClockBurst() {
+            // A quick burst on connect so the first estimate does not hinge on a single sample
+            for (let i = 0; i < CLOCK_BURST; i++) setTimeout(sendPing, i * 100);
+        }
+        
+        function recordClockSample(pong) {
+            const now = clientNow();
+            const rtt = now - pong.client_time;
+            clockSamples.push({ t: now, rtt, offset: pong.server_time + rtt / 2 - now });
+            if (clockSamples.length > CLOCK_WINDOW) clockSamples.shift();
+            
+            // Queueing only ever adds delay, so the fastest quarter of the window is the most trustworthy
+            const best = [...clockSamples].sort((a, b) => a.rtt - b.rtt).slice(0, Math.max(1, clockSamples.length >> 2));
+            const meanRtt = clockSamples.reduce((sum, s) => sum + s.rtt, 0) / clockSamples.length;
+            clock.rtt = best[0].rtt;
+            clock.jitter = Math.sqrt(clockSamples.reduce((sum, s) => sum + (s.rtt - meanRtt) ** 2, 0) / clockSamples.length);
+            
+            // Least-squares fit of offset over time on the best samples estimates drift between the two clocks
+            const meanT = best.reduce((sum, s) => sum + s.t, 0) / best.length;
+            const meanOffset = best.reduce((sum, s) => sum + s.offset, 0) / best.length;
+            const spread = best.reduce((sum, s) => sum + (s.t - meanT) ** 2, 0);
+            const span = Math.max(...best.map(s => s.t)) - Math.min(...best.map(s => s.t));
+            const drift = best.length >= 4 && span > 30000
+                ? best.reduce((sum, s) => sum + (s.t - meanT) * (s.offset - meanOffset), 0) / spread
+                : 0;
+            // Ignore implausible fits (quartz drift is well under 500 ppm)
+            clock.drift = Math.abs(drift) < 5e-4 ? drift : 0;
+            clock.ref = meanT;
+            clock.offset = meanOffset;
+            
+            if (clockSamples.length === CLOCK_BURST || pingsSent % 6 === 0) {
+                const sortedRtts = clockSamples.map(s => s.rtt).sort((a, b) => a - b);
+                ws.send(JSON.stringify({
+                    type: 'sync_report',
+                    offset: Math.round(getServerTime() - clientNow()),
+                    rtt: Math.round(clock.rtt * 10) / 10,
+                    rtt_p95: Math.round(sortedRtts[Math.floor(sortedRtts.length * 0.95)] * 10) / 10,
+                    jitter: Math.round(clock.jitter * 10) / 10,
+                    drift_ppm: Math.round(clock.drift * 1e6 * 10) / 10,
+                    samples: clockSamples.length
+                }));
+            }
+        }
+        
+        function escapeHtml(text) {
+            const div = document.createElement('div');
+            div.textContent = text;
+            return div.innerHTML;
         }
         
         function formatTime(seconds) {
@@ -739,76 +2156,254 @@ HTML_CONTENT = """
             }
         }
         
-        function base64ToBlob(base64) {
-            const parts = base64.split(',');
-            const mimeMatch = parts[0].match(/:(.*?);/);
-            const mime = mimeMatch ? mimeMatch[1] : 'audio/mpeg';
-            const bstr = atob(parts[1]);
-            const n = bstr.length;
-            const u8arr = new Uint8Array(n);
-            for (let i = 0; i < n; i++) {
-                u8arr[i] = bstr.charCodeAt(i);
+        function alignPlayback(data) {
+            elements.playBtn.disabled = false; elements.pauseBtn.disabled = false;
+            elements.prevBtn.disabled = false; elements.nextBtn.disabled = false;
+            elements.seekBackBtn.disabled = false; elements.seekForwardBtn.disabled = false;
+            
+            clearTimeout(alignTimer);
+            isSeeking = true;
+            audio.playbackRate = 1;
+            if (data.is_playing) {
+                // Start at start_time if it is still ahead of us, otherwise jump to where the track is now
+                togglePlayPause(true);
+                const wait = data.start_time - getServerTime();
+                audio.currentTime = Math.max(0, data.position + Math.max(0, -wait) / 1000);
+                alignTimer = setTimeout(() => { audio.play().catch(console.error); isSeeking = false; }, Math.max(0, wait));
+            } else {
+                togglePlayPause(false);
+                audio.pause();
+                audio.currentTime = data.position;
+                alignTimer = setTimeout(() => isSeeking = false, 100);
             }
-            return new Blob([u8arr], { type: mime });
         }
         
-        async function uploadFileInChunks(file) {
-            return new Promise((resolve, reject) => {
-                const reader = new FileReader();
-                reader.onload = async (e) => {
-                    const base64 = e.target.result;
-                    const uploadId = Date.now() + '_' + Math.random().toString(36);
-                    const totalChunks = Math.ceil(base64.length / CHUNK_SIZE);
-                    
-                    elements.uploadProgress.style.display = 'block';
-                    elements.progressText.textContent = `Uploading ${file.name}`;
-                    
-                    for (let i = 0; i < totalChunks; i++) {
-                        const chunk = base64.slice(i * CHUNK_SIZE, (i + 1) * CHUNK_SIZE);
-                        ws.send(JSON.stringify({
-                            type: 'upload_chunk',
-                            upload_id: uploadId,
-                            song_name: file.name,
-                            chunk_index: i,
-                            total_chunks: totalChunks,
-                            chunk_data: chunk
-                        }));
-                        const progress = ((i + 1) / totalChunks * 100).toFixed(0);
-                        document.getElementById('progressPercent').textContent = `${progress}%`;
-                        elements.progressBarFill.style.width = progress + '%';
-                        await new Promise(r => setTimeout(r, 10));
-                    }
-                    setTimeout(() => {
-                         elements.uploadProgress.style.display = 'none';
-                         elements.progressBarFill.style.width = '0%';
-                    }, 1000);
-                    resolve();
-                };
-                reader.onerror = reject;
-                reader.readAsDataURL(file);
+        function expectedPosition() {
+            return currentPlayback.position + (getServerTime() - currentPlayback.start_time) / 1000;
+        }
+        
+        function correctDrift() {
+            if (!currentPlayback || !currentPlayback.is_playing || isSeeking || audio.paused || audio.readyState < 3) return;
+            const error = audio.currentTime - expectedPosition();
+            driftErrors.push(error);
+            if (Math.abs(error) > DRIFT_HARD_SEEK) {
+                hardSeeks++;
+                audio.playbackRate = 1;
+                audio.currentTime = expectedPosition();
+            } else if (Math.abs(error) > DRIFT_DEADBAND) {
+                // Close about half the gap per second; preservesPitch keeps the nudge inaudible
+                audio.preservesPitch = true;
+                audio.playbackRate = 1 - Math.max(-DRIFT_MAX_NUDGE, Math.min(DRIFT_MAX_NUDGE, error / 2));
+            } else {
+                audio.playbackRate = 1;
+            }
+        }
+        
+        function reportPlaybackError() {
+            if (!driftErrors.length || !ws || ws.readyState !== WebSocket.OPEN) return;
+            const errors = driftErrors.map(Math.abs);
+            ws.send(JSON.stringify({
+                type: 'playback_report',
+                error_ms: Math.round(errors.reduce((sum, e) => sum + e, 0) / errors.length * 1000 * 10) / 10,
+                max_error_ms: Math.round(Math.max(...errors) * 1000 * 10) / 10,
+                rate: audio.playbackRate,
+                hard_seeks: hardSeeks
+            }));
+            driftErrors = [];
+        }
+        
+        function applyPlayback(playback) {
+            // Playback messages carry the whole playback state, so only the newest one matters
+            if (playback.seq <= playbackSeq) return;
+            playbackSeq = playback.seq;
+            if (playback.type && playback.is_playing && playback.start_time) {
+                // Tell the server when a scheduled start reached us too late, so it can lengthen the lead
+                const late = getServerTime() - playback.start_time;
+                if (late > 0) ws.send(JSON.stringify({ type: 'playback_late', seq: playback.seq, late_ms: late }));
+            }
+            currentPlayback = playback;
+            if (!playback.song) {
+                renderPlaylist();
+                return;
+            }
+            elements.songName.textContent = playback.song.name;
+            if (currentSongId !== playback.song.id) {
+                // Audio is streamed from /songs/{id}; the browser fetches byte ranges as needed
+                currentSongId = playback.song.id;
+                audio.onloadedmetadata = () => alignPlayback(currentPlayback);
+                audio.src = playback.song.url;
+            } else if (audio.readyState >= 1) {
+                alignPlayback(playback);
+            } else {
+                audio.onloadedmetadata = () => alignPlayback(currentPlayback);
+            }
+            renderPlaylist();
+        }
+        
+        function applyPatch(patch) {
+            if (stateVersion === null || patch.v <= stateVersion) return;
+            if (patch.v !== stateVersion + 1) {
+                // Missed a patch: drop local state and ask for a fresh snapshot
+                stateVersion = null;
+                ws.send(JSON.stringify({ type: 'get_state' }));
+                return;
+            }
+            stateVersion = patch.v;
+            if (patch.op === 'playlist_insert') { playlistSize++; insertSong(patch.song, patch.after); renderPlaylist(); }
+            else if (patch.op === 'playlist_remove') { playlistSize--; playlist = playlist.filter(song => song.id !== patch.id); renderPlaylist(); }
+            else if (patch.op === 'playlist_move') {
+                const song = playlist.find(song => song.id === patch.id);
+                playlist = playlist.filter(song => song.id !== patch.id);
+                // A song moved in from beyond the loaded songs arrives with the next page instead
+                if (song) insertSong(song, patch.after);
+                renderPlaylist();
+            }
+            else if (patch.op === 'playlist_update') { playlist = playlist.map(song => song.id === patch.song.id ? patch.song : song); renderPlaylist(); }
+            else if (patch.op === 'presence') showPresence(patch);
+        }
+        
+        function showPresence(presence) {
+            elements.userCount.textContent = presence.user_count;
+            const notice = text => ({ username: 'System', text, timestamp: Date.now(), isSystem: true, isAdmin: false });
+            const notices = (presence.joined || []).map(name => notice(`${name} joined the room`))
+                .concat((presence.left || []).map(name => notice(`${name} left the room`)));
+            if (notices.length) addChatMessages(notices);
+        }
+        
+        function insertSong(song, after) {
+            // Only the loaded prefix of the playlist is kept, so songs placed past it are skipped
+            const index = after === null ? 0 : playlist.findIndex(s => s.id === after) + 1;
+            if (index > 0 || after === null) playlist.splice(index, 0, song);
+        }
+        
+        function loadMoreSongs() {
+            if (playlistLoading || playlist.length >= playlistSize) return;
+            playlistLoading = true;
+            ws.send(JSON.stringify({ type: 'get_playlist', offset: playlist.length }));
+        }
+        
+        function addPlaylistPage(page) {
+            playlistLoading = false;
+            // Pages and patches arrive in order, so a page matches the playlist once every patch before it is applied
+            if (page.v !== stateVersion || page.offset !== playlist.length) return loadMoreSongs();
+            playlist = playlist.concat(page.songs);
+            renderPlaylist();
+        }
+        
+        function uploadFrame(uploadId, offset, chunk) {
+            // [u8 id length][u64 offset][upload id][payload]; the File slice is sent as-is, never base64-encoded
+            const id = new TextEncoder().encode(uploadId);
+            const header = new DataView(new ArrayBuffer(9));
+            header.setUint8(0, id.length);
+            header.setUint32(1, Math.floor(offset / 2 ** 32));
+            header.setUint32(5, offset >>> 0);
+            return new Blob([header.buffer, id, chunk]);
+        }
+        
+        function showUploadProgress(upload) {
+            const progress = (upload.acked / upload.file.size * 100).toFixed(0);
+            document.getElementById('progressPercent').textContent = `${progress}%`;
+            elements.progressBarFill.style.width = progress + '%';
+        }
+        
+        function handleUploadAck(uploadId, offset) {
+            const upload = activeUploads.get(uploadId);
+            if (!upload) return;
+            if (offset === null) {
+                // Server lost the upload (e.g. TTL expired); start over
+                upload.acked = 0;
+                ws.send(JSON.stringify({ type: 'upload_start', upload_id: uploadId, song_name: upload.file.name, size: upload.file.size, mime: upload.file.type, duration: upload.duration }));
+                return;
+            }
+            if (!upload.ready) { upload.next = offset; upload.ready = true; }
+            upload.acked = Math.max(upload.acked, offset);
+            showUploadProgress(upload);
+            upload.wake();
+        }
+        
+        function failUpload(uploadId, reason) {
+            const upload = activeUploads.get(uploadId);
+            if (upload) { upload.failed = true; upload.wake(); }
+            alert(`Upload failed: ${reason}`);
+        }
+        
+        function resumeUploads() {
+            activeUploads.forEach((upload, uploadId) => {
+                upload.ready = false;
+                ws.send(JSON.stringify({ type: 'upload_status', upload_id: uploadId }));
             });
         }
         
-        function renderPlaylist(playlist, currentIndex) {
-            if (playlist.length === 0) {
+        function probeDuration(file) {
+            // The server times auto-advance from the track length, so measure it before uploading
+            return new Promise(resolve => {
+                const probe = new Audio();
+                const url = URL.createObjectURL(file);
+                const done = (duration) => { URL.revokeObjectURL(url); resolve(isFinite(duration) ? duration : null); };
+                probe.preload = 'metadata';
+                probe.onloadedmetadata = () => done(probe.duration);
+                probe.onerror = () => done(null);
+                setTimeout(() => done(null), 5000);
+                probe.src = url;
+            });
+        }
+        
+        async function uploadFileInChunks(file) {
+            const uploadId = Date.now() + '_' + Math.random().toString(36).slice(2);
+            const upload = { file, duration: await probeDuration(file), acked: 0, next: 0, ready: false, wake: () => {} };
+            activeUploads.set(uploadId, upload);
+            
+            elements.uploadProgress.style.display = 'block';
+            elements.progressText.textContent = `Uploading ${file.name}`;
+            ws.send(JSON.stringify({
+                type: 'upload_start',
+                upload_id: uploadId,
+                song_name: file.name,
+                size: file.size,
+                mime: file.type,
+                duration: upload.duration
+            }));
+            
+            // Keep up to UPLOAD_WINDOW chunks unacknowledged, backing off while the socket buffer is full
+            const windowBytes = UPLOAD_WINDOW * CHUNK_SIZE;
+            while (upload.acked < file.size && !upload.failed) {
+                if (upload.ready && ws.readyState === WebSocket.OPEN && upload.next < file.size &&
+                    upload.next - upload.acked < windowBytes && ws.bufferedAmount < windowBytes) {
+                    ws.send(uploadFrame(uploadId, upload.next, file.slice(upload.next, upload.next + CHUNK_SIZE)));
+                    upload.next += CHUNK_SIZE;
+                    continue;
+                }
+                await new Promise(r => { upload.wake = r; setTimeout(r, 250); });
+            }
+            activeUploads.delete(uploadId);
+            setTimeout(() => {
+                 elements.uploadProgress.style.display = 'none';
+                 elements.progressBarFill.style.width = '0%';
+            }, 1000);
+        }
+        
+        function renderPlaylist() {
+            if (playlistSize === 0) {
                 elements.playlist.innerHTML = '<div style="text-align: center; color: var(--text-muted); padding: 40px; font-size: 13px;">No tracks in library</div>';
                 return;
             }
-            elements.playlist.innerHTML = playlist.map((song, index) => `
-                <div class="playlist-item ${index === currentIndex ? 'active' : ''}" data-index="${index}">
+            elements.playlist.innerHTML = playlist.map(song => `
+                <div class="playlist-item ${song.id === currentSongId ? 'active' : ''}" data-id="${song.id}">
                     <div style="flex:1; overflow:hidden;">
                         <span class="song-title">${song.name}</span>
+                        ${song.title || song.artist ? `<div style="font-size: 11px; color: var(--text-muted);">${escapeHtml([song.artist, song.title].filter(Boolean).join(' - '))}</div>` : ''}
                     </div>
+                    ${song.duration ? `<span style="font-size: 11px; color: var(--text-muted); margin: 0 8px;">${formatTime(song.duration)}</span>` : ''}
                     ${isAdmin ? `
                     <button class="remove-btn" data-id="${song.id}">Remove</button>` : ''}
                 </div>
-            `).join('');
+            `).join('') + (playlist.length < playlistSize ?
+                `<div style="text-align: center; color: var(--text-muted); padding: 12px; font-size: 12px;">${playlistSize - playlist.length} more tracks</div>` : '');
             
             document.querySelectorAll('.playlist-item').forEach(item => {
                 item.addEventListener('click', (e) => {
                     if (!e.target.closest('.remove-btn')) {
-                        const index = parseInt(item.dataset.index);
-                        ws.send(JSON.stringify({ type: 'change_song', index }));
+                        ws.send(JSON.stringify({ type: 'change_song', id: item.dataset.id }));
                     }
                 });
             });
@@ -822,7 +2417,7 @@ HTML_CONTENT = """
             });
         }
         
-        function addChatMessage(msg) {
+        function chatMessageElement(msg) {
             const messageDiv = document.createElement('div');
             messageDiv.className = `message ${msg.isSystem ? 'system' : ''}`;
             const time = new Date(msg.timestamp).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
@@ -836,25 +2431,44 @@ HTML_CONTENT = """
                 </div>
                 <div style="color:#ddd; font-size:13px; line-height:1.4;">${msg.text}</div>
             `;
-            elements.chatMessages.appendChild(messageDiv);
+            return messageDiv;
+        }
+        
+        function addChatMessages(messages, prepend = false) {
+            // One DOM insertion per batch, however many messages it holds
+            const fragment = document.createDocumentFragment();
+            messages.forEach(msg => fragment.appendChild(chatMessageElement(msg)));
+            if (prepend) {
+                elements.chatMessages.insertBefore(fragment, elements.chatMessages.firstChild);
+                return;
+            }
+            elements.chatMessages.appendChild(fragment);
             elements.chatMessages.scrollTop = elements.chatMessages.scrollHeight;
         }
         
-        function renderRequests(requests) {
-            const pending = requests.filter(r => r.status === 'pending');
-            
+        function showChatHistory(data) {
+            chatLoading = false;
+            const box = elements.chatMessages;
+            const height = box.scrollHeight;
+            addChatMessages(data.messages, true);
+            // Keep the messages the user was reading in place
+            box.scrollTop += box.scrollHeight - height;
+            chatOldest = data.has_more && data.messages.length ? data.messages[0].timestamp : null;
+        }
+        
+        function renderRequests() {
             if (!isAdmin) {
                 elements.requestsList.innerHTML = '';
                 return;
             }
             
             // Show the requests section for admin if there are pending requests
-            if (pending.length === 0) {
+            if (songRequests.length === 0) {
                 elements.requestsList.innerHTML = '<div style="text-align: center; color: var(--text-muted); padding: 10px; font-size: 11px;">No pending requests</div>';
                 return;
             }
             
-            elements.requestsList.innerHTML = pending.map(req => `
+            elements.requestsList.innerHTML = songRequests.map(req => `
                 <div class="request-item">
                     <div style="flex:1;">
                         <div style="font-weight:600; color:white; margin-bottom:2px;">${req.song_name}</div>
@@ -888,12 +2502,27 @@ HTML_CONTENT = """
             });
         }
         
+        function noteChat(messages) {
+            if (messages.length) lastChatTimestamp = Math.max(lastChatTimestamp, messages[messages.length - 1].timestamp);
+        }
+        
         function connect() {
             const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-            ws = new WebSocket(`${protocol}//${window.location.host}/ws`);
+            let url = `${protocol}//${window.location.host}/ws?room=${encodeURIComponent(room)}`;
+            if (resumeToken) {
+                url += `&resume=${resumeToken}&chat=${lastChatTimestamp}`;
+                // Versions are per server process; the server checks the epoch before replaying from one
+                if (stateVersion !== null) url += `&v=${stateVersion}&epoch=${stateEpoch}`;
+            }
+            ws = new WebSocket(url);
+            stateVersion = null;
             
             ws.onopen = () => {
+                reconnectAttempts = 0;
                 ws.send(JSON.stringify({ type: 'set_username', username }));
+                clockSamples = [];
+                startClockBurst();
+                resumeUploads();
                 elements.status.innerHTML = '<span style="width: 8px; height: 8px; background: currentColor; border-radius: 50%; box-shadow: 0 0 8px currentColor;"></span>Connected';
                 elements.status.className = 'status-pill';
             };
@@ -901,7 +2530,8 @@ HTML_CONTENT = """
             ws.onclose = () => {
                 elements.status.innerHTML = '<span style="width: 8px; height: 8px; background: currentColor; border-radius: 50%;"></span>Reconnecting...';
                 elements.status.className = 'status-pill disconnected';
-                setTimeout(connect, 1000);
+                // Exponential backoff with jitter, so a restarted server is not hit by every client at once
+                setTimeout(connect, 500 + Math.random() * Math.min(30000, 1000 * 2 ** reconnectAttempts++));
             };
             
             ws.onmessage = async (event) => {
@@ -911,6 +2541,7 @@ HTML_CONTENT = """
                     isAdmin = data.is_admin;
                     canUpload = data.can_upload;
                     userId = data.user_id;
+                    if (data.resume_token) resumeToken = data.resume_token;
                     elements.userRole.innerHTML = isAdmin ? '<span style="background:var(--accent-primary); padding:2px 6px; border-radius:4px; font-size:10px;">ADMIN</span>' : 'Listener';
                     
                     if (isAdmin) {
@@ -924,66 +2555,50 @@ HTML_CONTENT = """
                     }
                     
                     updateUploadUI();
+                    renderPlaylist();
+                    renderRequests();
                 }
-                else if (data.type === 'pong') {
-                    const roundTrip = performance.now() - data.client_time;
-                    serverTimeOffset = (data.server_time + (roundTrip / 2)) - Date.now();
-                }
+                else if (data.type === 'pong') recordClockSample(data);
                 else if (data.type === 'state') {
-                    renderPlaylist(data.playlist, data.current_index);
-                    renderRequests(data.song_requests);
+                    if (data.epoch !== stateEpoch) playbackSeq = -1;
+                    stateVersion = data.v;
+                    stateEpoch = data.epoch;
+                    playlist = data.playlist;
+                    playlistSize = data.playlist_size;
+                    playlistLoading = false;
+                    songRequests = data.song_requests || [];
+                    renderPlaylist();
+                    renderRequests();
                     elements.userCount.textContent = data.user_count;
-                    if (data.current_song) {
-                        const audioBlob = base64ToBlob(data.current_song.data);
-                        if (audio.src !== URL.createObjectURL(audioBlob)) audio.src = URL.createObjectURL(audioBlob);
-                        elements.songName.textContent = data.current_song.name;
-                        audio.onloadedmetadata = () => {
-                            elements.playBtn.disabled = false; elements.pauseBtn.disabled = false;
-                            elements.prevBtn.disabled = false; elements.nextBtn.disabled = false;
-                            elements.seekBackBtn.disabled = false; elements.seekForwardBtn.disabled = false;
-                            
-                            if (data.is_playing) {
-                                togglePlayPause(true);
-                                const targetTime = (getServerTime() - data.start_time) / 1000;
-                                audio.currentTime = Math.max(0, targetTime);
-                                audio.play().catch(console.error);
-                            } else {
-                                togglePlayPause(false);
-                                audio.pause();
-                                audio.currentTime = data.position;
-                            }
-                        };
-                    }
+                    applyPlayback(data.playback);
                     if (data.chat_messages) {
                         elements.chatMessages.innerHTML = '';
-                        data.chat_messages.forEach(addChatMessage);
-                    }
-                }
-                else if (data.type === 'play') {
-                    if (audio.src) {
-                        isSeeking = true;
-                        const targetTime = (getServerTime() - data.start_time) / 1000;
-                        audio.currentTime = Math.max(0, targetTime);
-                        setTimeout(async () => { await audio.play(); togglePlayPause(true); isSeeking = false; }, 10);
+                        addChatMessages(data.chat_messages);
+                        noteChat(data.chat_messages);
+                        chatOldest = data.chat_messages.length ? data.chat_messages[0].timestamp : null;
                     }
                 }
-                else if (data.type === 'pause') {
-                    isSeeking = true; audio.pause(); togglePlayPause(false); audio.currentTime = data.position; setTimeout(() => isSeeking = false, 100);
-                }
-                else if (data.type === 'seek') {
-                    isSeeking = true;
-                    if (data.is_playing) {
-                        const targetTime = (getServerTime() - data.start_time) / 1000;
-                        audio.currentTime = Math.max(0, targetTime);
-                        if (audio.paused) await audio.play();
-                    } else {
-                        audio.pause(); audio.currentTime = data.position;
-                    }
-                    setTimeout(() => isSeeking = false, 100);
+                else if (data.type === 'resume') {
+                    // Same session on the same server: missed patches follow this message
+                    stateVersion = data.v;
+                    elements.userCount.textContent = data.user_count;
+                    applyPlayback(data.playback);
+                    addChatMessages(data.chat_messages);
+                    noteChat(data.chat_messages);
                 }
-                else if (data.type === 'playlist_update') renderPlaylist(data.playlist, data.current_index);
-                else if (data.type === 'chat_message') addChatMessage(data);
-                else if (data.type === 'requests_update') renderRequests(data.requests);
+                else if (data.type === 'patch') applyPatch(data);
+                else if (['play', 'pause', 'seek', 'now_playing'].includes(data.type)) applyPlayback(data);
+                else if (data.type === 'playlist_page') addPlaylistPage(data);
+                else if (data.type === 'song_requests') { songRequests = data.requests; renderRequests(); }
+                else if (data.type === 'request_added') { songRequests.push(data.request); renderRequests(); }
+                else if (data.type === 'request_resolved') { songRequests = songRequests.filter(r => r.id !== data.id); renderRequests(); }
+                else if (data.type === 'chat_batch') { addChatMessages(data.messages); noteChat(data.messages); }
+                else if (data.type === 'chat_error' || data.type === 'request_error') addChatMessages([{ username: 'System', text: data.reason, timestamp: Date.now(), isSystem: true }]);
+                else if (data.type === 'chat_history') showChatHistory(data);
+                else if (data.type === 'upload_ack' || data.type === 'upload_status') handleUploadAck(data.upload_id, data.offset);
+                else if (data.type === 'upload_progress') elements.progressText.textContent = 'Processing upload...';
+                else if (data.type === 'upload_complete') elements.progressText.textContent = 'Upload complete';
+                else if (data.type === 'upload_error') failUpload(data.upload_id, data.reason);
                 else if (data.type === 'upload_permission') {
                     canUpload = data.can_upload;
                     updateUploadUI();
@@ -1019,6 +2634,15 @@ HTML_CONTENT = """
         }
         elements.sendBtn.onclick = sendMessage;
         elements.chatInput.onkeypress = (e) => { if (e.key === 'Enter') sendMessage(); };
+        elements.playlist.onscroll = () => {
+            const list = elements.playlist;
+            if (list.scrollTop + list.clientHeight >= list.scrollHeight - 200) loadMoreSongs();
+        };
+        elements.chatMessages.onscroll = () => {
+            if (elements.chatMessages.scrollTop > 0 || chatOldest === null || chatLoading) return;
+            chatLoading = true;
+            ws.send(JSON.stringify({ type: 'get_chat_history', before: chatOldest, limit: 50 }));
+        };
         
         elements.requestBtn.onclick = () => {
             const songName = elements.requestInput.value.trim();
@@ -1027,8 +2651,13 @@ HTML_CONTENT = """
         elements.requestInput.onkeypress = (e) => { if (e.key === 'Enter') elements.requestBtn.click(); };
         
         audio.addEventListener('timeupdate', updateProgress);
-        audio.addEventListener('ended', () => { togglePlayPause(false); ws.send(JSON.stringify({ type: 'next' })); });
-        setInterval(() => { if (ws && ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify({ type: 'ping', client_time: performance.now() })); }, 5000);
+        audio.addEventListener('ended', () => { togglePlayPause(false); ws.send(JSON.stringify({ type: 'next', ended: currentSongId })); });
+        audio.addEventListener('loadedmetadata', () => {
+            if (currentSongId && isFinite(audio.duration)) ws.send(JSON.stringify({ type: 'track_duration', song_id: currentSongId, duration: audio.duration }));
+        });
+        setInterval(sendPing, 5000);
+        setInterval(correctDrift, 500);
+        setInterval(reportPlaybackError, 10000);
         
         // Fix layout breaking on window resize (F12, etc)
         window.addEventListener('resize', () => {
@@ -1045,285 +2674,1368 @@ HTML_CONTENT = """
 """
 
 async def websocket_handler(request):
+    room_name = request.query.get('room', DEFAULT_ROOM)
+    if not ROOM_NAME_PATTERN.match(room_name):
+        raise web.HTTPBadRequest(text='Invalid room name')
+    
+    is_relay = 'relay' in request.query
+    if is_relay and (not RELAY_TOKEN or request.query['relay'] != RELAY_TOKEN):
+        raise web.HTTPForbidden(text='Invalid relay token')
+    
     ws = web.WebSocketResponse(heartbeat=30, max_msg_size=0)
     await ws.prepare(request)
     
-    user_id = str(uuid.uuid4())
-    is_admin = state.admin_id is None
+    # A copy made here only by other workers' events is partial, so it is loaded like a new room
+    snapshot = None
+    known = rooms.rooms.get(room_name)
+    if (known is None or not known.loaded) and snapshots and not RELAY_UPSTREAM:
+        snapshot = await snapshots.run(snapshots.read, room_name)
+    
+    state = rooms.get(room_name)
+    if not state.loaded:
+        if RELAY_UPSTREAM:
+            if state.upstream is None:
+                state.upstream = RelayLink(state)
+        elif snapshot:
+            restore_room(state, snapshot)
+        elif state.playlist:
+            # Whatever events built up here gives way to the live copy
+            state.restored = True
+        state.loaded = True
+        # Other workers may already host this room; ask them for its current state
+        publish(state, 'sync_request')
+    
+    session = None if is_relay else take_session(state, request.query.get('resume'))
+    user_id = session['id'] if session else str(uuid.uuid4())
+    # The admin's role is held while its session is; otherwise the first listener claims it.
+    # Relays never become admin, and neither does anyone listening through a relay
+    resumed_admin = session is not None and session['id'] == state.admin_id
+    is_admin = resumed_admin or (state.admin_id is None and not is_relay and not state.upstream)
     
     if is_admin:
-        state.admin_id = user_id
+        previous = state.admin_id
+        since = state.admin_since if resumed_admin else time.time()
+        set_admin(state, user_id, since, broker.worker_id if broker else None)
+        publish(state, 'admin', user_id=user_id, since=since, previous=previous)
     
-    state.clients[ws] = {
-        'id': user_id,
-        'username': None,
-        'is_admin': is_admin,
-        'can_upload': is_admin  # Admins can always upload
-    }
+    client = Client(ws, user_id, is_admin, is_relay, Outbox(ws, state))
+    if session:
+        client.username = session['username']
+        client.can_upload = is_admin or session['can_upload']
+    state.clients.add(client)
+    state.listener_count += client.listeners
     
-    await ws.send_json({
+    send(state, ws, {
         'type': 'init',
         'user_id': user_id,
         'is_admin': is_admin,
-        'can_upload': is_admin
+        'can_upload': client.can_upload,
+        'resume_token': client.token,
+        'resumed': session is not None
     })
     
-    await broadcast_state()
+    broadcast_presence(state)
+    if not (session and resume_state(state, client, request.query)):
+        send_state(state, ws)
     
     try:
         async for msg in ws:
             if msg.type == web.WSMsgType.TEXT:
-                data = json.loads(msg.data)
+                data = codec.loads(msg.data)
                 user_info = state.clients[ws]
                 
+                if user_info.relay:
+                    if data['type'] == 'relay_presence':
+                        # Counted into our own listeners, and so into what we report upstream when relaying
+                        state.listener_count += data['count'] - user_info.listeners
+                        user_info.listeners = data['count']
+                        broadcast_presence(state)
+                        continue
+                    if data['type'] not in RELAY_LOCAL_MESSAGES + RELAY_FORWARDED_MESSAGES:
+                        continue
+                    if state.upstream and data['type'] in RELAY_FORWARDED_MESSAGES:
+                        # Relays can be chained; the message still speaks for the listener it came from
+                        state.upstream.send(data)
+                        continue
+                    # Forwarded messages speak for a listener on the relay
+                    user_info = user_info.speaking_for(data.get('username'), data.get('user_id'))
+                
+                if state.upstream and data['type'] not in RELAY_LOCAL_MESSAGES:
+                    # The room is controlled upstream; only chat and song requests are passed on
+                    if data['type'] in RELAY_FORWARDED_MESSAGES and not throttled(state, ws, user_info, data['type']):
+                        state.upstream.send({**data, 'username': user_info.username, 'user_id': user_info.id})
+                    continue
+                
                 if data['type'] == 'set_username':
-                    user_info['username'] = data['username']
-                    await broadcast_chat({
-                        'username': 'System',
-                        'text': f"{data['username']} joined the room",
-                        'timestamp': time.time() * 1000,
-                        'isSystem': True,
-                        'isAdmin': False
-                    })
-                    await broadcast_state()
+                    # A resumed session already has its name; saying it again is not a new arrival
+                    if data['username'] != user_info.username:
+                        user_info.username = data['username']
+                        broadcast_presence(state, joined=data['username'])
+                
+                elif data['type'] == 'get_state':
+                    send_state(state, ws)
+                
+                elif data['type'] == 'sync_report':
+                    user_info.sync = {
+                        key: data.get(key) for key in ('offset', 'rtt', 'rtt_p95', 'jitter', 'drift_ppm', 'samples')
+                    }
+                
+                elif data['type'] == 'playback_late':
+                    late_ms = finite_number(data.get('late_ms'))
+                    if late_ms is None:
+                        continue
+                    for event in state.schedule_log:
+                        if event['seq'] == data.get('seq'):
+                            event['late'][user_info.id] = round(late_ms)
+                            break
+                
+                elif data['type'] == 'playback_report':
+                    user_info.playback = {
+                        key: data.get(key) for key in ('error_ms', 'max_error_ms', 'rate', 'hard_seeks')
+                    }
                 
                 elif data['type'] == 'ping':
-                    await ws.send_json({
+                    send(state, ws, {
                         'type': 'pong',
                         'client_time': data['client_time'],
-                        'server_time': time.time() * 1000
+                        'server_time': server_now_ms()
+                    }, 'control')
+                
+                elif data['type'] == 'upload_start' and user_info.can_upload:
+                    upload_id = data['upload_id']
+                    if len(upload_id.encode()) >= 256:
+                        continue
+                    if upload_id not in state.upload_chunks:
+                        size = data['size']
+                        if type(size) is not int or size <= 0:
+                            send(state, ws, {'type': 'upload_error', 'upload_id': upload_id, 'reason': 'invalid size'})
+                            continue
+                        upload = {
+                            'song_name': data['song_name'],
+                            'size': size,
+                            'mime': data.get('mime', ''),
+                            'duration': valid_duration(data.get('duration')),
+                            'received': 0,
+                            'hasher': hashlib.sha256(),
+                            'last_activity': time.time()
+                        }
+                        refused = uploads.admit(upload, user_info.id, size)
+                        if refused:
+                            send(state, ws, {'type': 'upload_error', 'upload_id': upload_id, 'reason': refused})
+                            continue
+                        upload['path'], upload['file'] = store.open_temp()
+                        state.upload_chunks[upload_id] = upload
+                    # Starting an upload that already exists resumes it from the acknowledged offset
+                    send(state, ws, {
+                        'type': 'upload_ack',
+                        'upload_id': upload_id,
+                        'offset': state.upload_chunks[upload_id]['received']
+                    })
+                
+                elif data['type'] == 'upload_status':
+                    upload = state.upload_chunks.get(data['upload_id'])
+                    send(state, ws, {
+                        'type': 'upload_status',
+                        'upload_id': data['upload_id'],
+                        'offset': upload['received'] if upload and 'received' in upload else None
                     })
                 
-                elif data['type'] == 'upload_chunk' and user_info['can_upload']:
+                elif data['type'] == 'upload_chunk' and user_info.can_upload:
                     upload_id = data['upload_id']
+                    chunk = data['chunk_data']
+                    upload = state.upload_chunks.get(upload_id)
                     
-                    if upload_id not in state.upload_chunks:
-                        state.upload_chunks[upload_id] = {
+                    if upload is None:
+                        total_chunks = data['total_chunks']
+                        if type(total_chunks) is not int or total_chunks <= 0:
+                            continue
+                        upload = {
                             'song_name': data['song_name'],
-                            'total_chunks': data['total_chunks'],
-                            'chunks': {}
+                            'total_chunks': total_chunks,
+                            'chunks': {},
+                            'spill_size': 0,
+                            'last_activity': time.time()
                         }
+                        # Chunks are equal-sized slices of the data URL, so the first one sizes the upload;
+                        # the reservation grows if it was the short final slice
+                        refused = uploads.admit(upload, user_info.id, len(chunk) * total_chunks)
+                        if refused:
+                            send(state, ws, {'type': 'upload_error', 'upload_id': upload_id, 'reason': refused})
+                            continue
+                        state.upload_chunks[upload_id] = upload
+                    elif 'chunks' not in upload:
+                        continue
                     
-                    state.upload_chunks[upload_id]['chunks'][data['chunk_index']] = data['chunk_data']
+                    index = data['chunk_index']
+                    if type(index) is not int or not 0 <= index < upload['total_chunks'] or index in upload['chunks']:
+                        continue
+                    if upload['held'] + len(chunk) > upload['reserved']:
+                        refused = uploads.grow(upload, upload['held'] + len(chunk))
+                        if refused:
+                            del state.upload_chunks[upload_id]
+                            discard_upload(upload)
+                            send(state, ws, {'type': 'upload_error', 'upload_id': upload_id, 'reason': refused})
+                            continue
+                    upload['last_activity'] = time.time()
                     
-                    if len(state.upload_chunks[upload_id]['chunks']) == data['total_chunks']:
-                        full_data = ''.join([
-                            state.upload_chunks[upload_id]['chunks'][i] 
-                            for i in range(data['total_chunks'])
-                        ])
-                        
-                        song_id = str(uuid.uuid4())
-                        state.playlist.append({
-                            'id': song_id,
-                            'name': data['song_name'],
-                            'data': full_data
-                        })
-                        
+                    if uploads.must_spill(upload, len(chunk)):
+                        if 'spill' not in upload:
+                            upload['spill_path'], upload['spill'] = store.open_spill()
+                        encoded = chunk.encode('ascii', 'replace')
+                        # Claim the range first; positional writes let chunks from several sockets land concurrently
+                        offset = upload['spill_size']
+                        upload['spill_size'] += len(encoded)
+                        uploads.hold(upload, len(encoded))
+                        await asyncio.get_running_loop().run_in_executor(None, spill_legacy_chunk, upload, offset, encoded)
+                        if state.upload_chunks.get(upload_id) is not upload:
+                            continue
+                        upload['chunks'][index] = (offset, len(encoded))
+                    else:
+                        uploads.hold(upload, len(chunk), in_memory=True)
+                        upload['chunks'][index] = chunk
+                    
+                    if len(upload['chunks']) == upload['total_chunks']:
                         del state.upload_chunks[upload_id]
-                        
-                        await broadcast_state()
+                        send(state, ws, {'type': 'upload_progress', 'upload_id': upload_id, 'stage': 'finalizing'})
+                        try:
+                            digest, size, mime = await asyncio.get_running_loop().run_in_executor(
+                                None, assemble_legacy_upload, upload)
+                        except ValueError as e:
+                            send(state, ws, {'type': 'upload_error', 'upload_id': upload_id, 'reason': str(e)})
+                            continue
+                        finally:
+                            discard_upload(upload)
+                        song = add_song(state, upload['song_name'], digest, size, mime, uploader=user_info.id)
+                        send(state, ws, {'type': 'upload_complete', 'upload_id': upload_id, 'song_id': song['id']})
                 
-                elif data['type'] == 'remove_song' and user_info['is_admin']:
-                    state.playlist = [s for s in state.playlist if s['id'] != data['id']]
-                    if state.current_song_index >= len(state.playlist):
-                        state.current_song_index = len(state.playlist) - 1
-                    await broadcast_state()
+                elif data['type'] == 'remove_song' and user_info.is_admin:
+                    if remove_song(state, data['id']):
+                        publish(state, 'playlist_remove', id=data['id'])
+                
+                elif data['type'] == 'move_song' and user_info.is_admin:
+                    if move_song(state, data['id'], data.get('after')):
+                        publish(state, 'playlist_move', id=data['id'], after=data.get('after'))
+                
+                elif data['type'] == 'get_playlist':
+                    offset = data.get('offset')
+                    offset = offset if type(offset) is int and offset > 0 else 0
+                    limit = data.get('limit')
+                    limit = min(limit, PLAYLIST_PAGE_SIZE) if type(limit) is int and limit > 0 else PLAYLIST_PAGE_SIZE
+                    send(state, ws, {
+                        'type': 'playlist_page',
+                        'v': state.version,
+                        'offset': offset,
+                        'size': len(state.playlist),
+                        'songs': [playlist_entry(song) for song in state.playlist.page(offset, limit)]
+                    })
                 
                 elif data['type'] == 'change_song':
-                    index = data['index']
-                    if 0 <= index < len(state.playlist):
-                        state.current_song_index = index
+                    song = state.find_song(data.get('id'))
+                    if song:
+                        state.current_song_id = song['id']
                         state.current_position = 0
                         state.is_playing = False
                         state.start_time = None
-                        await broadcast_state()
+                        broadcast_playback(state, 'now_playing')
                 
                 elif data['type'] == 'play':
                     state.is_playing = True
                     state.current_position = state.get_current_position()
-                    state.start_time = int(time.time() * 1000) + 50
-                    await broadcast({
-                        'type': 'play',
-                        'start_time': state.start_time
-                    })
+                    state.start_time = schedule_start(state)
+                    broadcast_playback(state, 'play')
                 
                 elif data['type'] == 'pause':
+                    # Where the listener's player stopped, or where the room's clock says it is
+                    position = finite_number(data.get('position'))
+                    state.current_position = max(0, position) if position is not None else state.get_current_position()
                     state.is_playing = False
-                    state.current_position = data.get('position', state.get_current_position())
                     state.start_time = None
-                    await broadcast({
-                        'type': 'pause',
-                        'position': state.current_position
-                    })
+                    broadcast_playback(state, 'pause')
                 
-                elif data['type'] == 'seek' and user_info['is_admin']:
-                    state.current_position = data['position']
+                elif data['type'] == 'seek' and user_info.is_admin:
+                    position = finite_number(data.get('position'))
+                    if position is None:
+                        continue
+                    current_song = state.get_current_song()
+                    state.current_position = max(0, position)
+                    if current_song and current_song['duration']:
+                        state.current_position = min(state.current_position, current_song['duration'])
                     if state.is_playing:
-                        state.start_time = int(time.time() * 1000) + 50
-                    await broadcast({
-                        'type': 'seek',
-                        'position': state.current_position,
-                        'is_playing': state.is_playing,
-                        'start_time': state.start_time
-                    })
+                        state.start_time = schedule_start(state)
+                    broadcast_playback(state, 'seek')
                 
                 elif data['type'] == 'next':
-                    if state.current_song_index < len(state.playlist) - 1:
-                        state.current_song_index += 1
-                        state.current_position = 0
-                        state.start_time = int(time.time() * 1000) + 50 if state.is_playing else None
-                        await broadcast_state()
+                    if 'ended' in data:
+                        # Every listener reports the end of the track; the server's own timer handles tracks
+                        # with a known duration, otherwise only the first report for the current track counts
+                        current_song = state.get_current_song()
+                        if not current_song or current_song['id'] != data['ended'] or current_song['duration']:
+                            continue
+                    step_track(state, 1)
                 
                 elif data['type'] == 'previous':
-                    if state.current_song_index > 0:
-                        state.current_song_index -= 1
-                        state.current_position = 0
-                        state.start_time = int(time.time() * 1000) + 50 if state.is_playing else None
-                        await broadcast_state()
+                    step_track(state, -1)
+                
+                elif data['type'] == 'track_duration':
+                    song = state.find_song(data['song_id'])
+                    duration = valid_duration(data.get('duration'))
+                    # The server's timer advances the whole room on this, so only the admin or the uploader is trusted
+                    trusted = user_info.is_admin or (song and user_info.id == song.get('uploader'))
+                    if song and duration and not song['duration'] and trusted:
+                        set_duration(state, song, duration)
+                        publish(state, 'duration', id=song['id'], duration=duration)
                 
                 elif data['type'] == 'chat':
+                    if throttled(state, ws, user_info, 'chat'):
+                        continue
                     chat_msg = {
-                        'username': user_info['username'],
+                        'username': user_info.username,
                         'text': data['text'],
                         'timestamp': time.time() * 1000,
                         'isSystem': False,
-                        'isAdmin': user_info['is_admin']
+                        'isAdmin': user_info.is_admin
                     }
-                    state.chat_messages.append(chat_msg)
-                    await broadcast_chat(chat_msg)
+                    record_chat(state, chat_msg)
+                    broadcast_chat(state, chat_msg)
+                
+                elif data['type'] == 'get_chat_history':
+                    before = data.get('before')
+                    if not isinstance(before, (int, float)) or isinstance(before, bool):
+                        before = None
+                    limit = data.get('limit')
+                    limit = min(limit, CHAT_PAGE_LIMIT) if type(limit) is int and limit > 0 else CHAT_HISTORY_SIZE
+                    messages, has_more = await chat_history(state, before, limit)
+                    send(state, ws, {'type': 'chat_history', 'messages': messages, 'has_more': has_more})
                 
-                elif data['type'] == 'request_song' and not user_info['is_admin']:
+                elif data['type'] == 'request_song' and not user_info.is_admin:
+                    song_name = data['song_name'].strip()
+                    if not song_name or throttled(state, ws, user_info, 'request_song'):
+                        continue
+                    refused = state.song_requests.check(user_info.id, song_name)
+                    if refused:
+                        send(state, ws, {'type': 'request_error', 'reason': refused})
+                        continue
                     request = {
                         'id': str(uuid.uuid4()),
-                        'song_name': data['song_name'],
-                        'requested_by': user_info['username'],
-                        'user_id': user_info['id'],
+                        'song_name': song_name,
+                        'requested_by': user_info.username,
+                        'user_id': user_info.id,
                         'status': 'pending'
                     }
-                    state.song_requests.append(request)
-                    
-                    # Broadcast to all clients immediately
-                    await broadcast({
-                        'type': 'requests_update',
-                        'requests': state.song_requests
-                    })
+                    state.song_requests.add(request)
+                    send_to_admins(state, {'type': 'request_added', 'request': request})
+                    publish(state, 'request_added', request=request)
                     
                     # Also send chat notification
-                    await broadcast_chat({
+                    broadcast_chat(state, {
                         'username': 'System',
-                        'text': f"🎵 {user_info['username']} requested: {data['song_name']}",
+                        'text': f"🎵 {user_info.username} requested: {song_name}",
                         'timestamp': time.time() * 1000,
                         'isSystem': True,
                         'isAdmin': False
                     })
                 
-                elif data['type'] == 'handle_request' and user_info['is_admin']:
-                    request_id = data['request_id']
-                    action = data['action']
-                    
-                    for req in state.song_requests:
-                        if req['id'] == request_id:
-                            req['status'] = action
-                            
-                            if action == 'approve':
-                                # Grant upload permission to the requesting user
-                                requester_user_id = data.get('user_id')
-                                if requester_user_id:
-                                    for client_ws, client_info in state.clients.items():
-                                        if client_info['id'] == requester_user_id:
-                                            client_info['can_upload'] = True
-                                            await client_ws.send_json({
-                                                'type': 'upload_permission',
-                                                'can_upload': True
-                                            })
-                                            break
-                                
-                                await broadcast_chat({
-                                    'username': 'System',
-                                    'text': f"✅ Song request '{req['song_name']}' by {req['requested_by']} was approved! {req['requested_by']} can now upload the song.",
-                                    'timestamp': time.time() * 1000,
-                                    'isSystem': True,
-                                    'isAdmin': False
-                                })
-                            else:
-                                await broadcast_chat({
-                                    'username': 'System',
-                                    'text': f"❌ Song request '{req['song_name']}' by {req['requested_by']} was rejected.",
-                                    'timestamp': time.time() * 1000,
-                                    'isSystem': True,
-                                    'isAdmin': False
-                                })
-                            break
+                elif data['type'] == 'handle_request' and user_info.is_admin:
+                    status = 'approved' if data['action'] == 'approve' else 'rejected'
+                    req = resolve_request(state, data['request_id'], status)
+                    if req is None:
+                        continue
+                    publish(state, 'request_resolved', id=req['id'], status=status)
                     
-                    await broadcast_requests()
+                    if status == 'approved':
+                        # Grant upload permission to the requesting user
+                        if not grant_upload(state, req['user_id']):
+                            publish(state, 'grant_upload', user_id=req['user_id'])
+                        
+                        broadcast_chat(state, {
+                            'username': 'System',
+                            'text': f"✅ Song request '{req['song_name']}' by {req['requested_by']} was approved! {req['requested_by']} can now upload the song.",
+                            'timestamp': time.time() * 1000,
+                            'isSystem': True,
+                            'isAdmin': False
+                        })
+                    else:
+                        broadcast_chat(state, {
+                            'username': 'System',
+                            'text': f"❌ Song request '{req['song_name']}' by {req['requested_by']} was rejected.",
+                            'timestamp': time.time() * 1000,
+                            'isSystem': True,
+                            'isAdmin': False
+                        })
+            
+            elif msg.type == web.WSMsgType.BINARY and state.clients[ws].can_upload:
+                frame = parse_upload_frame(msg.data)
+                if frame is None:
+                    continue
+                upload_id, offset, payload = frame
+                upload = state.upload_chunks.get(upload_id)
+                # Frames that do not continue the upload exactly (e.g. replays after a resume) are dropped
+                if upload is None or 'file' not in upload or offset != upload['received']:
+                    continue
+                # Nor may an upload grow past the size it was admitted with
+                if upload['received'] + len(payload) > upload['size']:
+                    continue
+                
+                # Claim the range before writing so a second socket resuming the same upload cannot write it too
+                upload['received'] += len(payload)
+                upload['last_activity'] = time.time()
+                uploads.hold(upload, len(payload))
+                # Disk writes and hashing run in a worker thread so the loop keeps serving pings and playback
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, write_upload_frame, upload, payload)
+                
+                if upload['received'] >= upload['size']:
+                    send(state, ws, {'type': 'upload_progress', 'upload_id': upload_id, 'stage': 'finalizing'})
+                    digest = await loop.run_in_executor(None, finish_upload_file, upload)
+                    uploads.release(upload)
+                    # Keep a finished marker until the TTL so a late upload_status still reports completion
+                    state.upload_chunks[upload_id] = {
+                        'received': upload['received'],
+                        'last_activity': upload['last_activity']
+                    }
+                
+                send(state, ws, {
+                    'type': 'upload_ack',
+                    'upload_id': upload_id,
+                    'offset': upload['received']
+                })
+                
+                if upload['received'] >= upload['size']:
+                    song = add_song(state, upload['song_name'], digest, upload['received'], upload['mime'],
+                                    upload['duration'], state.clients[ws].id)
+                    send(state, ws, {'type': 'upload_complete', 'upload_id': upload_id, 'song_id': song['id']})
     
     finally:
-        user_info = state.clients.pop(ws, None)
-        if user_info and user_info['username']:
-            await broadcast_chat({
-                'username': 'System',
-                'text': f"{user_info['username']} left the room",
-                'timestamp': time.time() * 1000,
-                'isSystem': True,
-                'isAdmin': False
-            })
+        user_info = state.clients.remove(ws)
+        if user_info:
+            user_info.outbox.close()
+            state.listener_count -= user_info.listeners
         
-        if user_info and user_info['id'] == state.admin_id:
-            state.admin_id = None
-            if state.clients:
-                next_admin_ws = list(state.clients.keys())[0]
-                state.clients[next_admin_ws]['is_admin'] = True
-                state.clients[next_admin_ws]['can_upload'] = True
-                state.admin_id = state.clients[next_admin_ws]['id']
-                await next_admin_ws.send_json({
-                    'type': 'init',
-                    'user_id': state.admin_id,
-                    'is_admin': True,
-                    'can_upload': True
-                })
-        
-        await broadcast_state()
+        if user_info and not user_info.relay and ws.close_code not in CLEAN_CLOSE_CODES:
+            # Dropped rather than closed; the client will likely be back within the grace period
+            hold_session(state, user_info)
+            broadcast_presence(state)
+        else:
+            if user_info and user_info.id == state.admin_id:
+                hand_over_admin(state)
+            broadcast_presence(state, left=user_info and user_info.username)
     
     return ws
 
-async def broadcast(message):
+def send(state, ws, message, kind='reply'):
+    client = state.clients.get(ws)
+    if client:
+        client.outbox.put(kind, codec.dumps(message))
+
+def broadcast(state, message, kind):
     if state.clients:
-        await asyncio.gather(
-            *[client.send_json(message) for client in state.clients.keys()],
-            return_exceptions=True
-        )
+        # Encode once and queue the same frame for every socket in the room; slow sockets never hold us up
+        fan_out(state, codec.dumps(message), kind)
+
+def fan_out(state, payload, kind):
+    for client in state.clients.values():
+        client.outbox.put(kind, payload)
 
-async def broadcast_state():
+def playback_payload(state):
     current_song = state.get_current_song()
-    await broadcast({
-        'type': 'state',
-        'playlist': [{'id': s['id'], 'name': s['name']} for s in state.playlist],
-        'current_index': state.current_song_index,
-        'current_song': current_song,
+    # While playing, the track is at position + (now - start_time)
+    return {
+        'seq': state.playback_seq,
+        'song': song_payload(state, current_song) if current_song else None,
         'is_playing': state.is_playing,
         'start_time': state.start_time,
-        'position': state.get_current_position(),
-        'user_count': len(state.clients),
-        'chat_messages': state.chat_messages[-50:],
-        'song_requests': state.song_requests
-    })
+        'position': state.current_position
+    }
+
+def state_snapshot(state, client):
+    # Listeners get the first page and fetch the rest with get_playlist; relays mirror all of it
+    songs = state.playlist if client.relay else state.playlist.page(0, PLAYLIST_PAGE_SIZE)
+    snapshot = {
+        'type': 'state',
+        'v': state.version,
+        'epoch': state.epoch,
+        'playlist': [playlist_entry(s) for s in songs],
+        'playlist_size': len(state.playlist),
+        'playback': playback_payload(state),
+        'user_count': state.user_count(),
+        'chat_messages': list(state.chat_messages)
+    }
+    # Only the admin acts on song requests
+    if client.is_admin:
+        snapshot['song_requests'] = state.song_requests.dump()
+    return snapshot
+
+def send_state(state, ws):
+    client = state.clients.get(ws)
+    if client:
+        send(state, ws, state_snapshot(state, client), 'state')
+
+def broadcast_patch(state, op, **fields):
+    state.version += 1
+    payload = codec.dumps({'type': 'patch', 'v': state.version, 'op': op, **fields})
+    state.patch_log.append((state.version, payload))
+    fan_out(state, payload, 'patch')
 
-async def broadcast_chat(message):
-    await broadcast({
-        'type': 'chat_message',
-        **message
+def resume_state(state, client, query):
+    """Brings a resumed client up to date from the patch log; False if it needs a full snapshot."""
+    try:
+        since = int(query.get('v', ''))
+        chat_since = float(query.get('chat') or 0)
+    except ValueError:
+        return False
+    if query.get('epoch') != state.epoch or since > state.version:
+        return False
+    missed = [payload for version, payload in state.patch_log if version > since]
+    if len(missed) != state.version - since:
+        # The log no longer reaches back that far
+        return False
+    send(state, client.ws, {
+        'type': 'resume',
+        'v': since,
+        'playback': playback_payload(state),
+        'user_count': state.user_count(),
+        'chat_messages': [m for m in state.chat_messages if m['timestamp'] > chat_since]
     })
+    for payload in missed:
+        client.outbox.put('patch', payload)
+    if client.is_admin:
+        send(state, client.ws, {'type': 'song_requests', 'requests': state.song_requests.dump()})
+    return True
+
+def hold_session(state, client):
+    session = {
+        'id': client.id,
+        'username': client.username,
+        'can_upload': client.can_upload,
+        'expires': time.time() + RESUME_GRACE
+    }
+    state.sessions[client.token] = session
+    state.session_timers[client.token] = asyncio.get_running_loop().call_later(
+        RESUME_GRACE, expire_session, state, client.token)
+    # Reconnects may land on another worker
+    publish(state, 'session', token=client.token, session=session)
+
+def take_session(state, token):
+    session = state.sessions.pop(token, None) if token else None
+    if session is None:
+        return None
+    end_session(state, token)
+    publish(state, 'session_end', token=token)
+    return session if session['expires'] > time.time() else None
+
+def end_session(state, token):
+    state.sessions.pop(token, None)
+    timer = state.session_timers.pop(token, None)
+    if timer:
+        timer.cancel()
+
+def expire_session(state, token):
+    state.session_timers.pop(token, None)
+    session = state.sessions.pop(token, None)
+    if session is None:
+        return
+    publish(state, 'session_end', token=token)
+    if session['id'] == state.admin_id:
+        hand_over_admin(state)
+    broadcast_presence(state, left=session['username'])
+
+def finite_number(value):
+    # Whatever a client sent for a time or a delay, if it is usable as one
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) else None
+
+def valid_duration(duration):
+    return float(duration) if isinstance(duration, (int, float)) and 0 < duration < 86400 else None
+
+def set_duration(state, song, duration):
+    song['duration'] = duration
+    if song is state.get_current_song():
+        schedule_advance(state)
+
+def step_track(state, step):
+    song_id = state.playlist.neighbour(state.current_song_id, step)
+    if song_id is not None:
+        state.current_song_id = song_id
+        state.current_position = 0
+        state.start_time = schedule_start(state) if state.is_playing else None
+        broadcast_playback(state, 'now_playing')
+        return True
+    return False
+
+def owns_timeline(state):
+    # One process advances each room: the worker holding the admin, never a relay
+    return not state.upstream and (broker is None or state.admin_worker == broker.worker_id)
+
+def schedule_advance(state):
+    if state.advance_timer:
+        state.advance_timer.cancel()
+        state.advance_timer = None
+    current_song = state.get_current_song()
+    if state.is_playing and current_song and current_song['duration'] and owns_timeline(state):
+        remaining = current_song['duration'] - state.get_current_position()
+        state.advance_timer = asyncio.get_running_loop().call_later(max(0, remaining), advance_track, state)
+
+def advance_track(state):
+    state.advance_timer = None
+    if not step_track(state, 1):
+        # End of the playlist
+        state.is_playing = False
+        state.current_position = state.get_current_song()['duration']
+        state.start_time = None
+        broadcast_playback(state, 'pause')
+
+def schedule_start(state):
+    # A command takes about half a round trip to arrive; the slowest 5% of clients set the pace
+    rtts = sorted(client.sync['rtt_p95'] for client in state.clients.values() if client.sync and client.sync['rtt_p95'])
+    slow_rtt = rtts[int(len(rtts) * 0.95)] if rtts else 0
+    state.lead_ms = int(min(LEAD_MAX_MS, max(LEAD_MIN_MS, slow_rtt / 2 + LEAD_DECODE_MARGIN_MS)))
+    return int(server_now_ms()) + state.lead_ms
+
+def announce_playback(state, kind):
+    state.playback_seq += 1
+    if state.is_playing and state.start_time:
+        state.schedule_log.append({
+            'seq': state.playback_seq,
+            'kind': kind,
+            'start_time': state.start_time,
+            'lead_ms': state.lead_ms,
+            'clients': len(state.clients),
+            'late': {}  # user id -> ms after start_time the command arrived
+        })
+    broadcast(state, {'type': kind, **playback_payload(state)}, 'playback')
+    schedule_advance(state)
+
+def broadcast_playback(state, kind):
+    announce_playback(state, kind)
+    current_song = state.get_current_song()
+    publish(state, 'playback',
+            kind=kind,
+            song_id=current_song['id'] if current_song else None,
+            is_playing=state.is_playing,
+            start_time=state.start_time,
+            position=state.current_position)
+
+def broadcast_presence(state, joined=None, left=None):
+    # Names are passed on to other workers straight away; counts go with the coalesced patch
+    if joined or left:
+        publish(state, 'presence_names', joined=joined, left=left)
+    queue_presence(state, joined, left)
 
-async def broadcast_requests():
-    await broadcast({
-        'type': 'requests_update',
-        'requests': state.song_requests
+def queue_presence(state, joined=None, left=None):
+    if joined:
+        state.presence_joined.append(joined)
+    if left:
+        state.presence_left.append(left)
+    if state.presence_flush is None:
+        state.presence_flush = asyncio.get_running_loop().call_later(PRESENCE_INTERVAL, flush_presence, state)
+
+def flush_presence(state):
+    state.presence_flush = None
+    if state.is_empty():
+        state.empty_since = time.time()
+    count = state.user_count()
+    broadcast_patch(state, 'presence', user_count=count, delta=count - state.presence_count,
+                    joined=state.presence_joined, left=state.presence_left)
+    state.presence_count = count
+    state.presence_joined, state.presence_left = [], []
+    if state.listener_count != state.presence_published:
+        state.presence_published = state.listener_count
+        publish(state, 'presence', count=state.listener_count)
+    if state.upstream:
+        state.upstream.report(state.listener_count)
+
+def queue_chat(state, message):
+    state.chat_pending.append(message)
+    if state.chat_flush is None:
+        state.chat_flush = asyncio.get_running_loop().call_later(CHAT_BATCH_INTERVAL, flush_chat, state)
+
+def flush_chat(state):
+    state.chat_flush = None
+    messages, state.chat_pending = state.chat_pending, []
+    broadcast(state, {'type': 'chat_batch', 'messages': messages}, 'chat')
+
+def broadcast_chat(state, message):
+    queue_chat(state, message)
+    publish(state, 'chat', message=message)
+
+def record_chat(state, message):
+    # Only the worker that accepted a message archives it, so a shared chat directory holds each line once
+    state.chat_messages.append(message)
+    if state.upstream is None:
+        chat_archive.append(state.name, message)
+
+async def chat_history(state, before, limit):
+    """Returns up to `limit` messages older than `before`, oldest first, and whether there are more."""
+    recent = [m for m in state.chat_messages if before is None or m['timestamp'] < before]
+    if len(recent) > limit:
+        return recent[-limit:], True
+    messages = await chat_archive.read(state.name, before, limit + 1)
+    if messages is None:
+        # Nothing archived here (e.g. on a relay); the in-memory window is all there is
+        return recent, False
+    return messages[-limit:], len(messages) > limit
+
+def throttled(state, ws, client, kind):
+    # Relays have already applied these limits to each of their listeners
+    if client.relay:
+        return False
+    if kind == 'chat' and not client.allow_chat():
+        send(state, ws, {'type': 'chat_error', 'reason': 'You are sending messages too fast'})
+        return True
+    if kind == 'request_song' and not client.allow_request():
+        send(state, ws, {'type': 'request_error', 'reason': 'Please wait before requesting another song'})
+        return True
+    return False
+
+def send_to_admins(state, message):
+    for client in state.clients.roles['admin'].values():
+        send(state, client.ws, message)
+
+def resolve_request(state, request_id, status):
+    request = state.song_requests.resolve(request_id, status)
+    if request:
+        send_to_admins(state, {'type': 'request_resolved', 'id': request_id, 'status': status})
+    return request
+
+def grant_upload(state, user_id):
+    client = state.clients.find(user_id)
+    if client is None:
+        return False
+    client.can_upload = True
+    send(state, client.ws, {
+        'type': 'upload_permission',
+        'can_upload': True
     })
+    return True
+
+def set_admin(state, user_id, since, worker):
+    client = state.clients.find(state.admin_id)
+    if client and user_id != state.admin_id:
+        # Lost a race against an earlier claim on another worker
+        state.clients.set_admin(client, False)
+        send(state, client.ws, {'type': 'init', 'user_id': client.id, 'is_admin': False, 'can_upload': False})
+    state.admin_id, state.admin_since, state.admin_worker = user_id, since, worker
+    # The timeline follows the admin between workers
+    schedule_advance(state)
+
+def hand_over_admin(state):
+    previous = state.admin_id
+    promote_next_admin(state)
+    if state.admin_id is None:
+        # Nobody left here; listeners on other workers take over
+        publish(state, 'admin', user_id=None, since=None, previous=previous)
+
+def promote_next_admin(state):
+    previous = state.admin_id
+    state.admin_id = None
+    next_admin = state.clients.first('listener')
+    if next_admin and not state.upstream:
+        state.clients.set_admin(next_admin, True)
+        set_admin(state, next_admin.id, time.time(), broker.worker_id if broker else None)
+        send(state, next_admin.ws, {
+            'type': 'init',
+            'user_id': state.admin_id,
+            'is_admin': True,
+            'can_upload': True
+        })
+        send(state, next_admin.ws, {'type': 'song_requests', 'requests': state.song_requests.dump()})
+        publish(state, 'admin', user_id=state.admin_id, since=state.admin_since, previous=previous)
+
+def publish(state, event, **fields):
+    if broker:
+        broker.publish({'room': state.name, 'event': event, **fields})
+
+def room_dump(state):
+    current_song = state.get_current_song()
+    return {
+        'playlist': list(state.playlist),
+        'song_id': current_song['id'] if current_song else None,
+        'is_playing': state.is_playing,
+        'start_time': state.start_time,
+        'position': state.current_position,
+        'chat_messages': list(state.chat_messages),
+        'song_requests': state.song_requests.dump(),
+        'admin': [state.admin_id, state.admin_since, state.admin_worker],
+        'count': state.listener_count
+    }
+
+def room_snapshot(state):
+    # Encoded on the snapshot thread: the containers are copied here, and songs only ever have
+    # existing fields replaced, so they can be shared
+    current_song = state.get_current_song()
+    return {
+        'playlist': list(state.playlist),
+        'song_id': current_song['id'] if current_song else None,
+        'is_playing': state.is_playing,
+        'position': max(0, state.get_current_position()),
+        'saved_at': time.time(),
+        'chat_messages': list(state.chat_messages),
+        'song_requests': state.song_requests.dump()
+    }
+
+def room_fingerprint(state):
+    # Changes to the playlist bump the version and playback changes the seq
+    pending = state.song_requests.pending
+    return (state.version, state.playback_seq, len(state.chat_messages) and state.chat_messages[-1]['timestamp'],
+            len(pending), next(reversed(pending), None))
+
+def restore_room(state, snapshot):
+    """Loads a saved room. If it was playing, playback moves on by the time the room was
+    down, through as many tracks as that covers."""
+    for song in state.playlist:
+        if song['hash']:
+            store.release(song['hash'])
+    for song in snapshot['playlist']:
+        if song['hash']:
+            store.restore(song['hash'])
+    state.song_requests = RequestStore()
+    state.playlist = Playlist(snapshot['playlist'])
+    state.chat_messages = collections.deque(snapshot['chat_messages'], maxlen=CHAT_HISTORY_SIZE)
+    for request in snapshot['song_requests']:
+        state.song_requests.add(request)
+    song = state.find_song(snapshot['song_id'])
+    position = snapshot['position']
+    state.is_playing = snapshot['is_playing'] and song is not None
+    if state.is_playing:
+        elapsed = max(0, time.time() - snapshot['saved_at'])
+        while song['duration'] and position + elapsed >= song['duration']:
+            following = state.playlist.neighbour(song['id'], 1)
+            if following is None:
+                # Ran off the end of the playlist
+                state.is_playing = False
+                position, elapsed = song['duration'], 0
+                break
+            elapsed -= song['duration'] - position
+            song, position = state.find_song(following), 0
+        position += elapsed
+    state.current_song_id = song['id'] if song else None
+    state.current_position = position
+    state.start_time = server_now_ms() if state.is_playing else None
+    state.loaded = True
+    state.restored = True
+    snapshots.saved[state.name] = room_fingerprint(state)
+
+def save_rooms():
+    pending = []
+    for state in list(rooms.rooms.values()):
+        if not state.loaded or state.upstream:
+            continue
+        # One room that cannot be saved must not stop the others
+        try:
+            future = snapshots.save(state)
+        except Exception:
+            logger.exception('Saving room %s failed', state.name)
+            continue
+        if future:
+            pending.append(future)
+    return pending
+
+def apply_remote(event):
+    """Replays a state change published by another worker onto our copy of the room."""
+    kind = event['event']
+    if kind == 'worker_down':
+        for state in list(rooms.rooms.values()):
+            if state.remote_counts.pop(event['worker'], None) is not None:
+                queue_presence(state)
+            if state.admin_worker == event['worker'] and state.admin_id:
+                promote_next_admin(state)
+        return
+    if kind == 'sync_request':
+        state = rooms.rooms.get(event['room'])
+        if state and state.loaded and (state.playlist or state.clients):
+            publish(state, 'sync', to=event['worker'], **room_dump(state))
+        return
+    if kind == 'sync' and event['to'] != broker.worker_id:
+        return
+    
+    if event['room'] not in rooms.rooms:
+        # This copy only has what happens from now on until a worker hosting the room syncs it
+        publish(rooms.get(event['room']), 'sync_request')
+    state = rooms.get(event['room'])
+    if kind == 'presence':
+        state.remote_counts[event['worker']] = event['count']
+        queue_presence(state)
+    elif kind == 'session':
+        state.sessions[event['token']] = event['session']
+    elif kind == 'session_end':
+        end_session(state, event['token'])
+    elif kind == 'presence_names':
+        queue_presence(state, event['joined'], event['left'])
+    elif kind == 'playlist_insert':
+        song = event['song']
+        store.acquire(song['hash'])
+        after = state.playlist.tail
+        state.playlist.append(song)
+        broadcast_patch(state, 'playlist_insert', after=after, song=playlist_entry(song))
+    elif kind == 'playlist_remove':
+        remove_song(state, event['id'])
+    elif kind == 'playlist_move':
+        move_song(state, event['id'], event['after'])
+    elif kind == 'playback':
+        song = state.find_song(event['song_id'])
+        state.current_song_id = song['id'] if song else None
+        state.is_playing = event['is_playing']
+        state.start_time = event['start_time']
+        state.current_position = event['position']
+        announce_playback(state, event['kind'])
+    elif kind == 'chat':
+        if not event['message']['isSystem']:
+            state.chat_messages.append(event['message'])
+        queue_chat(state, event['message'])
+    elif kind == 'request_added':
+        state.song_requests.add(event['request'])
+        send_to_admins(state, {'type': 'request_added', 'request': event['request']})
+    elif kind == 'request_resolved':
+        resolve_request(state, event['id'], event['status'])
+    elif kind == 'grant_upload':
+        grant_upload(state, event['user_id'])
+    elif kind == 'metadata':
+        song = state.find_song(event['id'])
+        if song:
+            apply_metadata(state, song, event['info'])
+    elif kind == 'duration':
+        song = state.find_song(event['id'])
+        if song and not song['duration']:
+            set_duration(state, song, event['duration'])
+    elif kind == 'admin':
+        if event['user_id'] is None:
+            if state.admin_id == event['previous']:
+                promote_next_admin(state)
+        elif (state.admin_id in (None, event['previous']) or
+                (event['since'], event['user_id']) < (state.admin_since, state.admin_id)):
+            set_admin(state, event['user_id'], event['since'], event['worker'])
+    elif kind == 'sync' and (state.restored or not state.loaded or not state.playlist):
+        # A live copy on another worker is newer than anything restored from a snapshot
+        for song in event['playlist']:
+            store.acquire(song['hash'])
+        for song in state.playlist:
+            store.release(song['hash'])
+        state.loaded = True
+        state.restored = False
+        state.song_requests = RequestStore()
+        state.playlist = Playlist(event['playlist'])
+        song = state.find_song(event['song_id'])
+        state.current_song_id = song['id'] if song else None
+        state.is_playing = event['is_playing']
+        state.start_time = event['start_time']
+        state.current_position = event['position']
+        state.playback_seq += 1
+        state.chat_messages = collections.deque(event['chat_messages'], maxlen=CHAT_HISTORY_SIZE)
+        for request in event['song_requests']:
+            state.song_requests.add(request)
+        state.remote_counts[event['worker']] = event['count']
+        admin_id, since, worker = event['admin']
+        if admin_id and (state.admin_id is None or (since, admin_id) < (state.admin_since, state.admin_id)):
+            set_admin(state, admin_id, since, worker)
+        # The room changed wholesale, so local listeners get a fresh snapshot
+        state.version += 1
+        for ws in state.clients:
+            send_state(state, ws)
+
+def discard_upload(upload):
+    uploads.release(upload)
+    if 'file' in upload:
+        upload['file'].close()
+        try:
+            os.remove(upload['path'])
+        except FileNotFoundError:
+            pass
+    if 'spill' in upload:
+        os.close(upload.pop('spill'))
+        os.remove(upload['spill_path'])
+
+async def collect_abandoned_uploads():
+    while True:
+        await asyncio.sleep(min(UPLOAD_TTL, 60))
+        expired = time.time() - UPLOAD_TTL
+        for state in list(rooms.rooms.values()):
+            for upload_id, upload in list(state.upload_chunks.items()):
+                if upload['last_activity'] < expired:
+                    del state.upload_chunks[upload_id]
+                    discard_upload(upload)
+
+async def snapshot_rooms():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        save_rooms()
+
+async def evict_idle_rooms():
+    while True:
+        await asyncio.sleep(min(ROOM_IDLE_TIMEOUT, 60))
+        rooms.evict_idle()
+
+loop_lag = collections.deque(maxlen=int(60 / LOOP_LAG_INTERVAL))
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.append(max(0, loop.time() - expected) * 1000)
+
+async def background_tasks(app):
+    global metadata_pool
+    metadata_pool = ProcessPoolExecutor(METADATA_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    tasks = [
+        asyncio.create_task(collect_abandoned_uploads()),
+        asyncio.create_task(evict_idle_rooms()),
+        asyncio.create_task(monitor_loop_lag())
+    ]
+    if snapshots and not RELAY_UPSTREAM:
+        store.saved = await snapshots.run(snapshots.read_refs)
+        tasks.append(asyncio.create_task(snapshot_rooms()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*(state.upstream.close() for state in rooms.rooms.values() if state.upstream))
+    if snapshots and not RELAY_UPSTREAM:
+        # Failures were logged as they happened
+        await asyncio.gather(*save_rooms(), return_exceptions=True)
+    # Joined here rather than left to exit handlers, where an idle pool process could keep a cluster worker alive
+    await asyncio.to_thread(metadata_pool.shutdown, cancel_futures=True)
+    metadata_pool = None
+
+class Broker:
+    """Runs in the parent process and fans every worker's events out to all other workers."""
+    
+    def __init__(self):
+        self.peers = {}
+    
+    async def handle(self, reader, writer):
+        worker_id = None
+        try:
+            while True:
+                header = await reader.readexactly(BROKER_FRAME_HEADER.size)
+                frame = await reader.readexactly(BROKER_FRAME_HEADER.unpack(header)[0])
+                if worker_id is None:
+                    worker_id = codec.loads(frame)['worker']
+                    self.peers[writer] = worker_id
+                else:
+                    self.relay(writer, header + frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peers.pop(writer, None)
+            writer.close()
+            if worker_id is not None:
+                frame = codec.dumps({'event': 'worker_down', 'worker': worker_id}).encode()
+                self.relay(writer, BROKER_FRAME_HEADER.pack(len(frame)) + frame)
+    
+    def relay(self, source, data):
+        for writer in self.peers:
+            if writer is not source:
+                writer.write(data)
+
+class BrokerLink:
+    def __init__(self, reader, writer, worker_id):
+        self.reader = reader
+        self.writer = writer
+        self.worker_id = worker_id
+    
+    def publish(self, event):
+        frame = codec.dumps({**event, 'worker': self.worker_id}).encode()
+        self.writer.write(BROKER_FRAME_HEADER.pack(len(frame)) + frame)
+    
+    async def listen(self):
+        global broker
+        try:
+            while True:
+                header = await self.reader.readexactly(BROKER_FRAME_HEADER.size)
+                frame = await self.reader.readexactly(BROKER_FRAME_HEADER.unpack(header)[0])
+                apply_remote(codec.loads(frame))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Broker went away; keep serving our own listeners on our own
+            broker = None
+
+def broker_link(path, worker_id):
+    async def connect(app):
+        global broker
+        reader, writer = await asyncio.open_unix_connection(path)
+        broker = BrokerLink(reader, writer, worker_id)
+        broker.publish({'event': 'hello'})
+        task = asyncio.create_task(broker.listen())
+        yield
+        task.cancel()
+        writer.close()
+        broker = None
+    return connect
+
+class RelayLink:
+    """Follows one room on the upstream server as a relay and mirrors it into the local copy."""
+    
+    def __init__(self, state):
+        self.state = state
+        self.session = aiohttp.ClientSession()
+        self.ws = None
+        self.version = None
+        self.others = 0  # Upstream listeners that are not ours
+        self.reported = 0
+        self.offset = 0  # Upstream clock minus ours, in ms
+        self.clock_samples = collections.deque(maxlen=8)
+        self.fetches = {}
+        self.task = asyncio.create_task(self.run())
+    
+    async def run(self):
+        url = f'{RELAY_UPSTREAM}/ws?room={quote(self.state.name)}&relay={quote(RELAY_TOKEN or "")}'
+        delay = 1
+        while True:
+            try:
+                async with self.session.ws_connect(url, heartbeat=30, max_msg_size=0) as ws:
+                    self.ws = ws
+                    self.version = None
+                    delay = 1
+                    self.report(self.state.listener_count, force=True)
+                    pinger = asyncio.create_task(self.ping())
+                    try:
+                        async for msg in ws:
+                            if msg.type == web.WSMsgType.TEXT:
+                                apply_upstream(self.state, codec.loads(msg.data))
+                    finally:
+                        pinger.cancel()
+            except (aiohttp.ClientError, OSError):
+                pass
+            except Exception:
+                # A frame we could not mirror; reconnecting starts over from a fresh state
+                logger.exception('Relay link for room %s failed', self.state.name)
+            self.ws = None
+            # Jittered so relays cut off together do not all come back at once
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, 30)
+    
+    async def ping(self):
+        while True:
+            self.send({'type': 'ping', 'client_time': server_now_ms()})
+            await asyncio.sleep(5)
+    
+    def clock_sample(self, pong):
+        now = server_now_ms()
+        rtt = now - pong['client_time']
+        self.clock_samples.append((rtt, pong['server_time'] + rtt / 2 - now))
+        # The sample with the shortest round trip has the least queueing noise
+        self.offset = min(self.clock_samples)[1]
+    
+    def local_time(self, upstream_time):
+        return None if upstream_time is None else int(upstream_time - self.offset)
+    
+    def send(self, message):
+        if self.ws and not self.ws.closed:
+            asyncio.create_task(self.ws.send_str(codec.dumps(message)))
+    
+    def report(self, count, force=False):
+        if count != self.reported or force:
+            self.reported = count
+            self.send({'type': 'relay_presence', 'count': count})
+    
+    def fetch(self, song):
+        task = self.fetches.get(song['id'])
+        if task is None:
+            task = self.fetches[song['id']] = asyncio.create_task(self.download(song))
+            task.add_done_callback(lambda _: self.fetches.pop(song['id'], None))
+        return task
+    
+    async def download(self, song):
+        url = f"{RELAY_UPSTREAM}/songs/{quote(song['id'])}?room={quote(self.state.name)}"
+        async with self.session.get(url) as response:
+            if response.status != 200:
+                return
+            tmp_path, f = store.open_temp()
+            hasher = hashlib.sha256()
+            size = 0
+            try:
+                async for chunk in response.content.iter_chunked(SONG_READ_CHUNK):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+            except BaseException:
+                f.close()
+                os.remove(tmp_path)
+                raise
+            f.close()
+        digest = hasher.hexdigest()
+        store.adopt(tmp_path, digest)
+        store.acquire(digest)
+        if self.state.find_song(song['id']) is song:
+            song.update(hash=digest, size=size, mime=response.content_type)
+        else:
+            # Removed while downloading
+            store.release(digest)
+    
+    def close(self):
+        """Stops following the room; returns the task closing the HTTP session."""
+        self.task.cancel()
+        for task in self.fetches.values():
+            task.cancel()
+        return asyncio.create_task(self.session.close())
+
+def mirror_playback(state, playback):
+    song = playback['song'] and state.find_song(playback['song']['id'])
+    state.current_song_id = song['id'] if song else None
+    state.is_playing = playback['is_playing']
+    state.start_time = state.upstream.local_time(playback['start_time'])
+    state.current_position = playback['position']
+    if song and not song['hash']:
+        # Start caching the track before the first listener asks for it
+        state.upstream.fetch(song)
+
+def apply_upstream(state, message):
+    """Mirrors a frame from the upstream server into a relayed room and passes it on to local listeners."""
+    link = state.upstream
+    kind = message['type']
+    if kind == 'pong':
+        link.clock_sample(message)
+    
+    elif kind == 'state':
+        cached = dict(state.playlist.songs)
+        state.playlist = Playlist(
+            cached.pop(song['id'], None) or {**song, 'hash': None, 'size': None, 'mime': None}
+            for song in message['playlist']
+        )
+        for song in cached.values():
+            if song['hash']:
+                store.release(song['hash'])
+        mirror_playback(state, message['playback'])
+        state.playback_seq += 1
+        state.chat_messages = collections.deque(message['chat_messages'], maxlen=CHAT_HISTORY_SIZE)
+        link.others = max(message['user_count'] - link.reported, 0)
+        link.version = message['v']
+        state.version += 1
+        for ws in state.clients:
+            send_state(state, ws)
+    
+    elif kind == 'patch':
+        if link.version is None or message['v'] != link.version + 1:
+            link.version = None
+            link.send({'type': 'get_state'})
+            return
+        link.version = message['v']
+        op = message['op']
+        fields = {key: value for key, value in message.items() if key not in ('type', 'v', 'op')}
+        if op == 'playlist_insert':
+            song = fields['song']
+            state.playlist.insert({**song, 'hash': None, 'size': None, 'mime': None}, fields['after'])
+        elif op == 'playlist_remove':
+            song = state.find_song(fields['id'])
+            if song:
+                # Upstream follows up with now_playing if this was the current track
+                if song['id'] == state.current_song_id:
+                    state.current_song_id = unlink_current(state)
+                state.playlist.remove(song['id'])
+                if song['hash']:
+                    store.release(song['hash'])
+        elif op == 'playlist_move':
+            state.playlist.move(fields['id'], fields['after'])
+        elif op == 'playlist_update':
+            song = state.find_song(fields['song']['id'])
+            if song:
+                song.update(fields['song'])
+        elif op == 'presence':
+            link.others = max(fields['user_count'] - link.reported, 0)
+            fields['user_count'] = state.user_count()
+        broadcast_patch(state, op, **fields)
+    
+    elif kind in ('play', 'pause', 'seek', 'now_playing'):
+        mirror_playback(state, message)
+        announce_playback(state, kind)
+    
+    elif kind == 'chat_batch':
+        for chat_msg in message['messages']:
+            if not chat_msg['isSystem']:
+                state.chat_messages.append(chat_msg)
+            queue_chat(state, chat_msg)
 
 async def index_handler(request):
     return web.Response(text=HTML_CONTENT, content_type='text/html')
 
-def create_app():
+async def stats_handler(request):
+    return web.json_response({
+        'uploads': uploads.stats(),
+        'loop_lag_ms': {
+            'last': round(loop_lag[-1], 1) if loop_lag else None,
+            'max_1m': round(max(loop_lag), 1) if loop_lag else None
+        },
+        'rooms': {
+            name: {
+                'user_count': state.user_count(),
+                'schedule': list(state.schedule_log),
+                'requests': {'pending': len(state.song_requests.pending), 'resolved': len(state.song_requests.resolved)},
+                'clients': [
+                    {'id': client.id, 'username': client.username, 'sync': client.sync, 'playback': client.playback, **client.outbox.stats()}
+                    for client in state.clients.values()
+                ]
+            }
+            for name, state in rooms.rooms.items()
+        }
+    }, dumps=codec.dumps)
+
+async def song_handler(request):
+    state = rooms.rooms.get(request.query.get('room', DEFAULT_ROOM))
+    song = state.find_song(request.match_info['song_id']) if state else None
+    if song and not song['hash'] and state.upstream:
+        # Relays fetch each track from upstream once and serve it from their own store afterwards
+        try:
+            await asyncio.shield(state.upstream.fetch(song))
+        except aiohttp.ClientError:
+            # Upstream unreachable; the next request tries again
+            raise web.HTTPBadGateway()
+    # Still no hash if upstream did not have the track either
+    path = store.path(song['hash']) if song and song['hash'] else None
+    if path is None or not os.path.exists(path):
+        raise web.HTTPNotFound()
+    
+    size = song['size']
+    etag = f'"{song["hash"]}"'
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'public, max-age=31536000, immutable'
+    }
+    
+    if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+        return web.Response(status=304, headers=headers)
+    
+    try:
+        rng = request.http_range
+    except ValueError:
+        # Unparseable ranges are ignored and the whole file is served
+        rng = slice(None, None)
+    if rng.start is not None and rng.start >= size:
+        headers['Content-Range'] = f'bytes */{size}'
+        raise web.HTTPRequestRangeNotSatisfiable(headers=headers)
+    
+    # If-Range with a stale validator means the client wants the whole file
+    if_range = request.headers.get('If-Range')
+    if rng.start is None or (if_range is not None and if_range != etag):
+        status, start, stop = 200, 0, size
+    else:
+        status = 206
+        start = max(size + rng.start, 0) if rng.start < 0 else rng.start
+        stop = min(rng.stop, size) if rng.stop is not None else size
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = song['mime']
+    response.content_length = stop - start
+    await response.prepare(request)
+    if request.method == 'HEAD':
+        return response
+    
+    loop = asyncio.get_running_loop()
+    try:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, f.read, min(SONG_READ_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await response.write(chunk)
+        await response.write_eof()
+    except ConnectionResetError:
+        # Browsers abort range requests on every seek and track change
+        pass
+    return response
+
+def create_app(broker_path=None, worker_id=None):
     app = web.Application(client_max_size=0)
     
     cors = aiohttp_cors.setup(app, defaults={
@@ -1335,13 +4047,70 @@ def create_app():
     })
     
     app.router.add_get('/', index_handler)
+    app.router.add_get('/rooms/{room}', index_handler)
     app.router.add_get('/ws', websocket_handler)
+    app.router.add_get('/songs/{song_id}', song_handler)
+    app.router.add_get('/stats', stats_handler)
+    app.cleanup_ctx.append(background_tasks)
+    if broker_path:
+        app.cleanup_ctx.append(broker_link(broker_path, worker_id))
     
     for route in list(app.router.routes()):
         cors.add(route)
     
     return app
 
+def run_worker(host, port, broker_path, worker_id, relay_upstream):
+    global RELAY_UPSTREAM
+    RELAY_UPSTREAM = relay_upstream
+    web.run_app(create_app(broker_path, worker_id), host=host, port=port, reuse_port=True, print=None)
+
+async def run_cluster(host, port, workers, relay_upstream):
+    broker_path = BROKER_PATH or os.path.join(tempfile.mkdtemp(prefix='musync-'), 'broker.sock')
+    server = await asyncio.start_unix_server(Broker().handle, path=broker_path)
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+    started = 0
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    print(f'======== Running {workers} workers on http://{host}:{port} ========')
+    try:
+        while not stopping.is_set():
+            for slot in range(workers):
+                process = processes.get(slot)
+                if process is None or not process.is_alive():
+                    # Crashed workers are replaced; the others pick up their admins via worker_down
+                    started += 1
+                    process = context.Process(target=run_worker, args=(host, port, broker_path, f'w{started}', relay_upstream))
+                    process.start()
+                    processes[slot] = process
+            try:
+                await asyncio.wait_for(stopping.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        while any(process.is_alive() for process in processes.values()):
+            await asyncio.sleep(0.1)
+        server.close()
+        os.remove(broker_path)
+
 if __name__ == '__main__':
-    app = create_app()
-    web.run_app(app, host='0.0.0.0', port=8080)
+    parser = argparse.ArgumentParser(description='Musync server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--relay', metavar='URL', default=RELAY_UPSTREAM,
+                        help='mirror rooms from the Musync server at URL instead of hosting them')
+    args = parser.parse_args()
+    RELAY_UPSTREAM = args.relay and args.relay.rstrip('/')
+    
+    if args.workers > 1:
+        try:
+            asyncio.run(run_cluster(args.host, args.port, args.workers, RELAY_UPSTREAM))
+        except KeyboardInterrupt:
+            pass
+    else:
+        app = create_app()
+        web.run_app(app, host=args.host, port=args.port)
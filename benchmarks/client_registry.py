@@ -0,0 +1,53 @@
+"""Per-operation cost of a room's ClientRegistry as the room grows.
+
+Run from the repository root: python benchmarks/client_registry.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Musync import Client, ClientRegistry
+
+OPERATIONS = 20000
+
+def bench(size):
+    registry = ClientRegistry()
+    # Every 50th socket is a relay, like a room with a few relays attached
+    for i in range(size):
+        registry.add(Client(object(), str(i), False, i % 50 == 0, None))
+    
+    # Connect and disconnect churn on top of the existing room
+    extra = [Client(object(), f'extra-{i}', False, False, None) for i in range(OPERATIONS)]
+    start = time.perf_counter()
+    for client in extra:
+        registry.add(client)
+    for client in extra:
+        registry.remove(client.ws)
+    churn = (time.perf_counter() - start) / (2 * OPERATIONS)
+    
+    start = time.perf_counter()
+    for i in range(OPERATIONS):
+        registry.find(str(i % size))
+    lookup = (time.perf_counter() - start) / OPERATIONS
+    
+    # Admin succession: take the oldest listener, then drop it as if it disconnected
+    rounds = min(OPERATIONS, len(registry.roles['listener']) - 1)
+    succession = None
+    if rounds >= 50:  # Fewer rounds are mostly timer noise
+        start = time.perf_counter()
+        for _ in range(rounds):
+            registry.remove(registry.first('listener').ws)
+        succession = (time.perf_counter() - start) / rounds
+    return churn, lookup, succession
+
+def main():
+    print(f"{'clients':>8} {'add/remove':>12} {'find':>10} {'succession':>12}")
+    for size in (10, 100, 1000, 10000, 50000):
+        churn, lookup, succession = bench(size)
+        succession = f'{succession * 1e9:9.0f} ns' if succession else f"{'-':>12}"
+        print(f'{size:>8} {churn * 1e9:9.0f} ns {lookup * 1e9:7.0f} ns {succession}')
+
+if __name__ == '__main__':
+    main()